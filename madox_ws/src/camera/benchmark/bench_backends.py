@@ -0,0 +1,112 @@
+"""Load test for the camera stream server backends.
+
+Start the camera node with one backend, run this script against it, then
+repeat with the other backend and compare the tables:
+
+    ros2 run camera ros2_camera --backend threaded
+    python3 bench_backends.py --url http://robot:8080/camera.mjpg \\
+        --label threaded --pid $(pgrep -f ros2_camera)
+
+    ros2 run camera ros2_camera --backend asyncio
+    python3 bench_backends.py --url http://robot:8080/camera.mjpg \\
+        --label asyncio --pid $(pgrep -f ros2_camera)
+
+--pid only works when the script runs on the robot; it adds the CPU used by
+the server process during each run.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from urllib.parse import urlparse
+
+
+class ClientStats(object):
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.first_frame = None
+
+
+async def mjpeg_client(host, port, path, duration, stats):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("GET {} HTTP/1.0\r\nHost: {}\r\n\r\n".format(path, host).encode())
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.decode("latin-1").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            if stats.first_frame is None:
+                stats.first_frame = time.time()
+            stats.frames += 1
+            stats.bytes += length
+    finally:
+        writer.close()
+
+
+def cpu_seconds(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, fields 14 and 15 of /proc/<pid>/stat
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run(url, clients, duration):
+    parts = urlparse(url)
+    stats = [ClientStats() for _ in range(clients)]
+    await asyncio.gather(
+        *[
+            mjpeg_client(parts.hostname, parts.port or 80, parts.path, duration, s)
+            for s in stats
+        ]
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080/camera.mjpg")
+    parser.add_argument("--label", type=str, default="")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--pid", type=int, default=None)
+    args = parser.parse_args()
+
+    print(
+        "{:<10} {:>7} {:>9} {:>9} {:>9} {:>8} {:>8}".format(
+            "backend", "clients", "fps min", "fps avg", "fps max", "MB/s", "cpu %"
+        )
+    )
+    for clients in args.clients:
+        cpu_start = cpu_seconds(args.pid) if args.pid else None
+        start = time.time()
+        stats = asyncio.run(run(args.url, clients, args.duration))
+        elapsed = time.time() - start
+        fps = [s.frames / args.duration for s in stats]
+        total_mb = sum(s.bytes for s in stats) / elapsed / 1e6
+        cpu = "-"
+        if cpu_start is not None:
+            cpu = "{:.0f}".format(100 * (cpu_seconds(args.pid) - cpu_start) / elapsed)
+        print(
+            "{:<10} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.2f} {:>8}".format(
+                args.label,
+                clients,
+                min(fps),
+                sum(fps) / len(fps),
+                max(fps),
+                total_mb,
+                cpu,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Memory churn of the capture and encode path with and without the pool.
+
+Plays a generated MJPEG file through cv2.VideoCapture, so no camera is
+needed, and pushes every frame through a FrameSlot and an EncodeCache like
+the camera node does. Reports time per frame, the number of image buffers
+allocated and the peak of memory traced by tracemalloc:
+
+    python3 bench_buffer_pool.py --frames 300 --width 1280 --height 720
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from camera.buffer_pool import FramePool  # noqa: E402
+from camera.camera import FrameSlot  # noqa: E402
+from camera.encoder import EncodeCache, StreamKey  # noqa: E402
+
+
+def make_video(path, width, height, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    base = np.random.randint(0, 255, (height, width, 3), np.uint8)
+    for i in range(frames):
+        writer.write(np.roll(base, i * 4, axis=1))
+    writer.release()
+
+
+def run(path, pooled):
+    cap = cv2.VideoCapture(path)
+    pool = FramePool()
+    slot = FrameSlot()
+    cache = EncodeCache(lambda image, key: image)
+    key = StreamKey(0, 80, 1.0)
+    frames = 0
+    allocated = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    while True:
+        buf = pool.acquire() if pooled else None
+        ret, image = cap.read(image=buf) if buf is not None else cap.read()
+        if not ret:
+            break
+        if image is not buf:
+            allocated += 1
+            if pooled:
+                pool.adopt(image)
+        slot.publish(image, time.time(), pool if pooled else None)
+        cache.get(key, slot.latest())
+        frames += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cap.release()
+    return elapsed / max(frames, 1) * 1e3, allocated, frames, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.avi")
+        make_video(path, args.width, args.height, args.frames)
+        print("{}x{}, {} frames".format(args.width, args.height, args.frames))
+        print("mode      ms/frame  buffers allocated  peak traced MB")
+        for pooled in (False, True):
+            ms, allocated, frames, peak = run(path, pooled)
+            print(
+                "{:9} {:8.2f}  {:>8} of {:<8} {:>8.1f}".format(
+                    "pool" if pooled else "cap.read", ms, allocated, frames, peak
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
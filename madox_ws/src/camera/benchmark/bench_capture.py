@@ -0,0 +1,90 @@
+"""Capture throughput and latency of the GStreamer pipelines.
+
+Needs OpenCV built with GStreamer. The "test" source is a live
+videotestsrc, so no camera is needed, "jetson" measures the CSI camera.
+A consumer that takes --work-ms per frame is simulated: with the default
+appsink queue, frames wait in the sink and get older and older, with
+drop=true max-buffers=1 they stay fresh.
+
+Latency is how far the buffer timestamp (CAP_PROP_POS_MSEC, running time
+of the live pipeline) lags behind the wall clock since the first frame:
+
+    python3 bench_capture.py --source test --framerate 30 --work-ms 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from camera.gst_pipeline import build_pipeline  # noqa: E402
+
+
+def run(pipeline, seconds, work):
+    cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+    if not cap.isOpened():
+        sys.exit("cannot open pipeline, is OpenCV built with GStreamer?")
+    frames = 0
+    lag = []
+    read_time = 0.0
+    first = None
+    end = time.time() + seconds
+    while time.time() < end:
+        start = time.time()
+        ret, _ = cap.read()
+        now = time.time()
+        if not ret:
+            continue
+        read_time += now - start
+        position = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if first is None:
+            first = (now, position)
+        lag.append((now - first[0]) - (position - first[1]))
+        frames += 1
+        time.sleep(work)
+    cap.release()
+    lag.sort()
+    return (
+        frames / seconds,
+        read_time / max(frames, 1) * 1e3,
+        lag[len(lag) // 2] * 1e3 if lag else 0.0,
+        lag[-1] * 1e3 if lag else 0.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="test", choices=["test", "jetson"])
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--framerate", type=int, default=30)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--work-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    print("appsink                      fps  read ms  lag p50 ms  lag max ms")
+    for drop, max_buffers, sync in ((False, 0, True), (True, 1, False)):
+        settings = {
+            "framerate": args.framerate,
+            "appsink_drop": drop,
+            "appsink_max_buffers": max_buffers,
+            "appsink_sync": sync,
+        }
+        pipeline = build_pipeline(args.source, args.width, args.height, settings)
+        fps, read_ms, lag_p50, lag_max = run(pipeline, args.seconds, args.work_ms / 1e3)
+        label = "drop={} max-buffers={} sync={}".format(
+            str(drop).lower(), max_buffers, str(sync).lower()
+        )
+        print(
+            "{:27} {:5.1f} {:8.2f} {:11.1f} {:11.1f}".format(
+                label, fps, read_ms, lag_p50, lag_max
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""JPEG encoding throughput in the node and in an EncodePool.
+
+Encodes a moving synthetic picture at 640x480 and 1280x720, first with
+cv2.imencode in this process, then through pools of 1 to 4 worker
+processes with every slot kept busy. The frames come back in order, which
+is checked. Then the same through the calls the node makes: one stream
+client calling EncodeCache.get() frame after frame, which waits for each
+encode, and the EncodePump submitting frames with up to one per worker in
+flight. Run it on the Jetson, the gain depends on the free cores:
+
+    python3 bench_encode_pool.py --seconds 5 --quality 80
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from camera.camera import Frame  # noqa: E402
+from camera.encode_pool import EncodePool  # noqa: E402
+from camera.encoder import EncodeCache, EncodePump, StreamKey  # noqa: E402
+
+SIZES = ((640, 480), (1280, 720))
+
+
+def make_frames(width, height, count=8):
+    # Gradient with noise, closer to a camera picture than pure noise
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.dstack([x + 0 * y, y + 0 * x, (x + y) / 2])
+    frames = []
+    for i in range(count):
+        noise = np.random.normal(0, 12, base.shape).astype(np.float32)
+        frames.append(
+            np.clip(np.roll(base, i * 16, axis=1) + noise, 0, 255).astype(np.uint8)
+        )
+    return frames
+
+
+def run_inline(frames, quality, seconds):
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        cv2.imencode(
+            ".jpg", frames[count % len(frames)], [cv2.IMWRITE_JPEG_QUALITY, quality]
+        )
+        count += 1
+    return count / seconds
+
+
+def run_pool(frames, quality, seconds, workers):
+    pool = EncodePool(workers)
+    pool.start()
+    pool.encode(frames[0], quality)
+    in_flight = deque()
+    count = 0
+    expected = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        # submit() blocks while all the slots are busy
+        in_flight.append(pool.submit(count, frames[count % len(frames)], quality))
+        count += 1
+        while in_flight and in_flight[0].done():
+            seq, _ = in_flight.popleft().result()
+            assert seq == expected, "frame {} came back as {}".format(expected, seq)
+            expected += 1
+    while in_flight:
+        seq, _ = in_flight.popleft().result()
+        assert seq == expected, "frame {} came back as {}".format(expected, seq)
+        expected += 1
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return expected / elapsed
+
+
+class EndlessCamera(object):
+    # A new frame whenever one is asked for, until the time is up
+    def __init__(self, frames, seconds):
+        self.frames = frames
+        self.end = time.perf_counter() + seconds
+
+    def is_opened(self):
+        return time.perf_counter() < self.end
+
+    def wait_frame(self, seq, timeout):
+        image = self.frames[seq % len(self.frames)]
+        return Frame(seq + 1, time.time(), image)
+
+
+def make_cache(workers):
+    pool = None
+    if workers:
+        pool = EncodePool(workers)
+        pool.start()
+    return EncodeCache(lambda image, key: image, encode_pool=pool), pool
+
+
+def run_client(frames, quality, seconds, workers):
+    cache, pool = make_cache(workers)
+    camera = EndlessCamera(frames, seconds)
+    key = StreamKey(0, quality, 1.0)
+    count = 0
+    start = time.perf_counter()
+    while camera.is_opened():
+        cache.get(key, camera.wait_frame(count, 0))
+        count += 1
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        pool.close()
+    return count / elapsed
+
+
+def run_pump(frames, quality, seconds, workers):
+    cache, pool = make_cache(workers)
+    delivered = []
+    pump = EncodePump(
+        EndlessCamera(frames, seconds), cache, lambda: StreamKey(0, quality, 1.0)
+    )
+    pump.add_sink(lambda encoded: delivered.append(encoded.seq))
+    start = time.perf_counter()
+    pump.run()
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        pool.close()
+    assert delivered == sorted(delivered), "frames delivered out of order"
+    return len(delivered) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--quality", type=int, default=80)
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    print("{} cpus".format(os.cpu_count()))
+    print("size        encoder     fps  speedup")
+    for width, height in SIZES:
+        frames = make_frames(width, height)
+        size = "{}x{}".format(width, height)
+        inline = run_inline(frames, args.quality, args.seconds)
+        print("{:11} {:10} {:6.1f} {:7.2f}x".format(size, "in-process", inline, 1.0))
+        for workers in range(1, args.max_workers + 1):
+            fps = run_pool(frames, args.quality, args.seconds, workers)
+            label = "{} worker{}".format(workers, "" if workers == 1 else "s")
+            print("{:11} {:10} {:6.1f} {:7.2f}x".format(size, label, fps, fps / inline))
+
+    print("node path   caller     workers    fps  speedup")
+    for width, height in SIZES:
+        frames = make_frames(width, height)
+        size = "{}x{}".format(width, height)
+        for caller, run in (("client", run_client), ("pump", run_pump)):
+            base = None
+            for workers in range(0, args.max_workers + 1):
+                fps = run(frames, args.quality, args.seconds, workers)
+                base = base or fps
+                print(
+                    "{:11} {:10} {:7} {:6.1f} {:7.2f}x".format(
+                        size, caller, workers, fps, fps / base
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
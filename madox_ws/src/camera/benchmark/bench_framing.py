@@ -0,0 +1,153 @@
+"""Cost of writing multipart frames to stream clients.
+
+Each client is one end of a socketpair, drained by a reader thread, and is
+served by its own writer thread like the threaded server does. Frames are
+published at --fps and every client writes every frame, either the way the
+handler used to (boundary, send_header() calls, end_headers(), payload:
+three writes and a string formatted per client) or with the prebuilt part
+header and one sendmsg() from camera.framing. Reports the send calls and
+the writer CPU time per frame sent:
+
+    python3 bench_framing.py --clients 8 --fps 30 --seconds 10
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from camera.encoder import EncodedFrame, StreamKey  # noqa: E402
+from camera.framing import send_parts  # noqa: E402
+
+
+class Counting(object):
+    # Counts the send calls going to the socket
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def write_separately(sock, encoded):
+    # What BaseHTTPRequestHandler did per frame: wfile.write() is a
+    # sendall(), send_header() formats into a buffer flushed by end_headers()
+    sock.sendall("--jpgboundary".encode())
+    headers = [
+        ("%s: %s\r\n" % ("Content-type", "image/jpeg")).encode("latin-1", "strict"),
+        ("%s: %s\r\n" % ("Content-length", str(encoded.nbytes))).encode(
+            "latin-1", "strict"
+        ),
+    ]
+    headers.append(b"\r\n")
+    sock.sendall(b"".join(headers))
+    sock.sendall(encoded.data)
+
+
+def write_sendmsg(sock, encoded):
+    send_parts(sock, (encoded.part_header, encoded.data))
+
+
+def drain(sockets, stop):
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        selector.register(sock, selectors.EVENT_READ)
+    buf = bytearray(256 * 1024)
+    while not stop.is_set():
+        for key, _ in selector.select(0.1):
+            key.fileobj.recv_into(buf)
+
+
+def run(write, clients, fps, seconds, frame_bytes):
+    pairs = [socket.socketpair() for _ in range(clients)]
+    stop = threading.Event()
+    reader = threading.Thread(target=drain, args=([b for _, b in pairs], stop))
+    reader.start()
+    cond = threading.Condition()
+    state = {"frame": None}
+    results = []
+
+    def client(sock):
+        counting = Counting(sock)
+        seq = 0
+        frames = 0
+        cpu = 0.0
+        while not stop.is_set():
+            with cond:
+                cond.wait_for(lambda: stop.is_set() or state["frame"].seq != seq, 0.5)
+                encoded = state["frame"]
+            if stop.is_set() or encoded.seq == seq:
+                continue
+            seq = encoded.seq
+            start = time.thread_time()
+            write(counting, encoded)
+            cpu += time.thread_time() - start
+            frames += 1
+        results.append((frames, counting.calls, cpu))
+
+    payloads = [os.urandom(frame_bytes + i * 97) for i in range(8)]
+    key = StreamKey(0, 80, 1.0)
+    with cond:
+        state["frame"] = EncodedFrame(0, time.time(), key, payloads[0])
+    writers = [threading.Thread(target=client, args=(a,)) for a, _ in pairs]
+    for writer in writers:
+        writer.start()
+    seq = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        seq += 1
+        with cond:
+            state["frame"] = EncodedFrame(
+                seq, time.time(), key, payloads[seq % len(payloads)]
+            )
+            cond.notify_all()
+        time.sleep(1.0 / fps)
+    stop.set()
+    with cond:
+        cond.notify_all()
+    for writer in writers:
+        writer.join()
+    reader.join()
+    for a, b in pairs:
+        a.close()
+        b.close()
+    frames = sum(r[0] for r in results)
+    calls = sum(r[1] for r in results)
+    cpu = sum(r[2] for r in results)
+    return frames, calls / max(frames, 1), cpu / max(frames, 1) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--frame-kb", type=int, default=40)
+    args = parser.parse_args()
+
+    print(
+        "{} clients, {:.0f} fps, {} kB frames".format(
+            args.clients, args.fps, args.frame_kb
+        )
+    )
+    print("framing     frames sent  send calls/frame  writer cpu us/frame")
+    for name, write in (("writes", write_separately), ("sendmsg", write_sendmsg)):
+        frames, calls, cpu = run(
+            write, args.clients, args.fps, args.seconds, args.frame_kb * 1024
+        )
+        print("{:11} {:11} {:17.2f} {:20.1f}".format(name, frames, calls, cpu))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Per-frame cost of the overlay with and without the caches.
+
+Runs on any machine with OpenCV and NumPy, no camera needed. The static
+part (crosshair and labels) is timed on its own, drawn or applied from the
+layer, which is built once per resolution like in the node. Run it on the
+robot to decide whether --text-cache pays off there:
+
+    python3 bench_overlay.py --frames 500 --change-every 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import camera.overlay_lib as overlay_lib  # noqa: E402
+
+
+def draw_static(frame, width, height, mode):
+    overlay_lib.draw_text(frame, 100, 100, "d: 0", width, height)
+    overlay_lib.drawCrosshair(frame, width, height)
+
+
+def draw_telemetry(frame, i, change_every, width, height):
+    # Values change every change_every frames, like telemetry at 15-30 fps
+    v = i // change_every
+    overlay_lib.draw_joy(frame, round(0.1 * (v % 10), 1), -0.5, width, height)
+    overlay_lib.draw_power(frame, "12.1V  95%", width, height)
+    overlay_lib.draw_CPU(frame, "CPU: 0.%02d" % (v % 100), width, height)
+    overlay_lib.draw_FPS(frame, "FPS: %d" % (14 + v % 3), width, height)
+    overlay_lib.draw_IMU(
+        frame, (1.2 + v % 7, -3.4, 180.1), 35.2, 412 + v % 2, width, height
+    )
+
+
+def build_layer(compositor, width, height):
+    # Done once per resolution and display config in the node
+    start = time.perf_counter()
+    compositor.layer(width, height, 0)
+    return (time.perf_counter() - start) * 1e3
+
+
+def run(compositor, width, height, frames, change_every, static_layer, text_cache):
+    overlay_lib.use_text_cache = text_cache
+    source = np.random.randint(0, 255, (height, width, 3), np.uint8)
+    frame = source.copy()
+    static = 0.0
+    elapsed = 0.0
+    for i in range(frames):
+        np.copyto(frame, source)
+        start = time.perf_counter()
+        if static_layer:
+            compositor.apply(frame, 0)
+        else:
+            draw_static(frame, width, height, 0)
+        drawn = time.perf_counter()
+        draw_telemetry(frame, i, change_every, width, height)
+        static += drawn - start
+        elapsed += time.perf_counter() - start
+    return static / frames * 1e6, elapsed / frames * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--change-every", type=int, default=5)
+    args = parser.parse_args()
+
+    print(
+        "{:<10} {:>8} {:>8} {:>10} {:>10}".format(
+            "size", "static", "text", "static us", "total us"
+        )
+    )
+    for width, height in [(640, 480), (1280, 720)]:
+        compositor = overlay_lib.OverlayCompositor(draw_static)
+        build_ms = build_layer(compositor, width, height)
+        for static_layer in (False, True):
+            for text_cache in (False, True):
+                # First run warms up the atlas caches
+                run(
+                    compositor,
+                    width,
+                    height,
+                    10,
+                    args.change_every,
+                    static_layer,
+                    text_cache,
+                )
+                static_us, us = run(
+                    compositor,
+                    width,
+                    height,
+                    args.frames,
+                    args.change_every,
+                    static_layer,
+                    text_cache,
+                )
+                print(
+                    "{:<10} {:>8} {:>8} {:>10.1f} {:>10.1f}".format(
+                        "%dx%d" % (width, height),
+                        "layer" if static_layer else "draw",
+                        "cache" if text_cache else "putText",
+                        static_us,
+                        us,
+                    )
+                )
+        print("{:<10} layer built once in {:.1f} ms".format("", build_ms))
+
+
+if __name__ == "__main__":
+    main()
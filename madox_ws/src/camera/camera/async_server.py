@@ -0,0 +1,430 @@
+import asyncio
+import threading
+import time
+
+from .camera import FRAME_TIMEOUT_IN_SEC
+from .framing import MULTIPART_TYPE, URL_PATH_MJPG, part_header
+from .log import logger
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, URL_PATH_METRICS, metrics
+from .playback import (
+    URL_PATH_PLAYBACK,
+    PlaybackCursor,
+    PlaybackError,
+    parse_playback_query,
+)
+from .recorder import RECORD_DIR
+from .static_files import URL_PATH_FAVICON, load_index
+from .still import URL_PATH_SNAPSHOT, etag, still_frame, still_key
+from .stream_session import (
+    RETRY_AFTER_IN_SEC,
+    WRITE_TIMEOUT_IN_SEC,
+    ClientLimit,
+    StreamSession,
+    configure_stream_writer,
+)
+from .variants import VariantError, parse_variant
+from .websocket import (
+    ACK_TIMEOUT_IN_SEC,
+    OP_BINARY,
+    OP_CLOSE,
+    OP_PING,
+    OP_PONG,
+    OP_TEXT,
+    URL_PATH_WS,
+    AckWindow,
+    MessageReader,
+    WebSocketError,
+    control_frame,
+    handshake,
+    parse_ack,
+    video_head,
+)
+
+MAX_REQUEST_BYTES = 16 * 1024
+
+
+class AsyncStreamServer(object):
+    """Serves the camera stream from a single asyncio event loop.
+
+    One feeder thread waits on the camera's frame slot and wakes up every
+    stream client on the loop, encoding runs in the default executor through
+    the shared EncodeCache. Routes map a path to a coroutine taking
+    (reader, writer, path, headers), new endpoints are added with add_route().
+    At most max_clients stream at once (0 is no limit), the others get a 503.
+    Only the stream routes wait on the camera.
+    """
+
+    def __init__(
+        self,
+        camera,
+        encoder,
+        document_root,
+        quality_tiers,
+        display_mode,
+        on_frame=None,
+        record_dir=RECORD_DIR,
+        max_clients=0,
+    ):
+        self.camera = camera
+        self.encoder = encoder
+        self.document_root = document_root
+        self.quality_tiers = quality_tiers
+        self.display_mode = display_mode
+        self.on_frame = on_frame
+        self.record_dir = record_dir
+        self.clients = ClientLimit(max_clients)
+        self.index_html = load_index(document_root)
+        self.routes = {
+            URL_PATH_MJPG: self.handle_stream,
+            URL_PATH_PLAYBACK: self.handle_playback,
+            URL_PATH_SNAPSHOT: self.handle_snapshot,
+            URL_PATH_METRICS: self.handle_metrics,
+            URL_PATH_WS: self.handle_websocket,
+            URL_PATH_FAVICON: self.handle_favicon,
+        }
+        self.default_route = self.handle_index
+        self._loop = None
+        self._server = None
+        self._frame = None
+        self._frame_ready = None
+        self._running = False
+
+    def add_route(self, path, handler):
+        self.routes[path] = handler
+
+    def serve_forever(self, host, port):
+        asyncio.run(self._serve(host, port))
+
+    def shutdown(self):
+        self._running = False
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _serve(self, host, port):
+        self._loop = asyncio.get_running_loop()
+        self._frame_ready = self._loop.create_future()
+        self._running = True
+        threading.Thread(
+            target=self._feed_frames, name="async-frame-feeder", daemon=True
+        ).start()
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        logger.info("asyncio server listening on {}:{}".format(host, port))
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        self._running = False
+
+    def _feed_frames(self):
+        # Bridges the capture thread to the event loop: one thread waits on
+        # the frame slot, however many clients are connected
+        seq = 0
+        while self._running and self.camera.is_opened():
+            frame = self.camera.wait_frame(seq, FRAME_TIMEOUT_IN_SEC)
+            if frame is None:
+                continue
+            seq = frame.seq
+            try:
+                self._loop.call_soon_threadsafe(self._publish, frame)
+            except RuntimeError:
+                # The event loop was closed by shutdown()
+                break
+
+    def _publish(self, frame):
+        self._frame = frame
+        ready, self._frame_ready = self._frame_ready, self._loop.create_future()
+        ready.set_result(frame)
+
+    async def next_frame(self, session):
+        # Newest frame not yet seen by this session, frames that arrived
+        # while the client was writing are skipped
+        while True:
+            frame = session.advance(self._frame)
+            if frame is not None:
+                return frame
+            # Shielded: a client going away must not cancel the future the
+            # other clients are waiting on
+            await asyncio.shield(self._frame_ready)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        path, headers = parse_request(request[:MAX_REQUEST_BYTES])
+        handler = self.routes.get(path.split("?", 1)[0], self.default_route)
+        try:
+            await handler(reader, writer, path, headers)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            logger.info("client gone: {error}".format(error=e))
+        finally:
+            writer.close()
+        logger.info("request done ... [{path}]".format(path=path))
+
+    async def handle_stream(self, reader, writer, path, headers):
+        try:
+            variant = parse_variant(path)
+        except VariantError as e:
+            writer.write(response_head(400, []))
+            writer.write(str(e).encode())
+            await writer.drain()
+            return
+        if not self.clients.acquire():
+            await self._reject(writer)
+            return
+        try:
+            configure_stream_writer(writer)
+            writer.write(response_head(200, [("Content-type", MULTIPART_TYPE)]))
+            peer = writer.get_extra_info("peername") or ("?", 0)
+            session = StreamSession(peer, self.quality_tiers, variant)
+            try:
+                await self._stream(writer, session)
+            finally:
+                session.close()
+                logger.info(session.summary())
+        finally:
+            self.clients.release()
+
+    async def _reject(self, writer):
+        writer.write(
+            response_head(
+                503,
+                [("Retry-After", str(RETRY_AFTER_IN_SEC)), ("Content-length", "0")],
+            )
+        )
+        await writer.drain()
+
+    async def _stream(self, writer, session):
+        loop = asyncio.get_running_loop()
+        while self._running and self.camera.is_opened():
+            frame = await self.next_frame(session)
+            key = session.key(self.display_mode())
+            jpg = await loop.run_in_executor(None, self.encoder.get, key, frame)
+            if jpg is None or not session.is_new(jpg):
+                continue
+            if self.on_frame is not None:
+                self.on_frame(jpg)
+            start_send = time.time()
+            writer.writelines((jpg.part_header, jpg.data))
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT_IN_SEC)
+            session.sent(jpg.nbytes, time.time() - start_send)
+
+    async def handle_websocket(self, reader, writer, path, headers):
+        try:
+            variant = parse_variant(path)
+            response = handshake(headers)
+        except (VariantError, WebSocketError) as e:
+            writer.write(response_head(400, []))
+            writer.write(str(e).encode())
+            await writer.drain()
+            return
+        if not self.clients.acquire():
+            await self._reject(writer)
+            return
+        try:
+            configure_stream_writer(writer)
+            writer.write(response)
+            peer = writer.get_extra_info("peername") or ("?", 0)
+            session = StreamSession(peer, self.quality_tiers, variant)
+            window = AckWindow()
+            acked = asyncio.Event()
+            acks = asyncio.ensure_future(self._read_acks(reader, writer, window, acked))
+            try:
+                await self._stream_websocket(writer, session, window, acked, acks)
+            finally:
+                acks.cancel()
+                session.close()
+                logger.info(session.summary())
+        finally:
+            self.clients.release()
+
+    async def _read_acks(self, reader, writer, window, acked):
+        parser = MessageReader()
+        try:
+            while True:
+                data = await reader.read(MAX_REQUEST_BYTES)
+                if not data:
+                    return
+                for opcode, payload in parser.feed(data):
+                    if opcode == OP_CLOSE:
+                        writer.write(control_frame(OP_CLOSE))
+                        return
+                    if opcode == OP_PING:
+                        writer.write(control_frame(OP_PONG, payload))
+                    elif opcode in (OP_TEXT, OP_BINARY):
+                        seq = parse_ack(payload)
+                        if seq is not None:
+                            window.ack(seq)
+                            acked.set()
+        except (ConnectionError, WebSocketError):
+            pass
+        finally:
+            # Wakes the sender so it notices the browser is gone
+            acked.set()
+
+    async def _stream_websocket(self, writer, session, window, acked, acks):
+        # One binary message per frame. At most window.size frames are in
+        # flight, the frames captured while waiting for an ack are skipped
+        loop = asyncio.get_running_loop()
+        while self._running and self.camera.is_opened() and not acks.done():
+            acked.clear()
+            if not window.can_send():
+                try:
+                    await asyncio.wait_for(acked.wait(), ACK_TIMEOUT_IN_SEC)
+                except asyncio.TimeoutError:
+                    window.expire()
+                continue
+            frame = await self.next_frame(session)
+            key = session.key(self.display_mode())
+            jpg = await loop.run_in_executor(None, self.encoder.get, key, frame)
+            if jpg is None or not session.is_new(jpg):
+                continue
+            if self.on_frame is not None:
+                self.on_frame(jpg)
+            start_send = time.time()
+            writer.writelines((video_head(jpg), jpg.data))
+            window.sent(jpg.seq)
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT_IN_SEC)
+            session.sent(jpg.nbytes, time.time() - start_send)
+
+    async def handle_playback(self, reader, writer, path, headers):
+        try:
+            session_dir, t, speed = parse_playback_query(path, self.record_dir)
+        except PlaybackError as e:
+            writer.write(response_head(404, []))
+            writer.write(str(e).encode())
+            await writer.drain()
+            return
+        if not self.clients.acquire():
+            await self._reject(writer)
+            return
+        try:
+            configure_stream_writer(writer)
+            writer.write(response_head(200, [("Content-type", MULTIPART_TYPE)]))
+            cursor = PlaybackCursor(session_dir, t, speed)
+            try:
+                while self._running:
+                    frame = cursor.next()
+                    if frame is None:
+                        break
+                    delay, timestamp, jpeg = frame
+                    if delay:
+                        await asyncio.sleep(delay)
+                    # Copied, the transport may keep the buffer after the
+                    # cursor has moved to another segment
+                    writer.writelines((part_header(len(jpeg)), bytes(jpeg)))
+                    await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT_IN_SEC)
+            finally:
+                cursor.close()
+        finally:
+            self.clients.release()
+
+    async def handle_snapshot(self, reader, writer, path, headers):
+        try:
+            variant = parse_variant(path)
+        except VariantError as e:
+            writer.write(response_head(400, []))
+            writer.write(str(e).encode())
+            await writer.drain()
+            return
+        key = still_key(variant, self.display_mode(), self.quality_tiers)
+        loop = asyncio.get_running_loop()
+        status, jpg = await loop.run_in_executor(
+            None,
+            still_frame,
+            self.camera,
+            self.encoder,
+            key,
+            headers.get("if-none-match"),
+        )
+        if status == 200:
+            writer.write(
+                response_head(
+                    200,
+                    [
+                        ("Content-type", "image/jpeg"),
+                        ("Content-length", str(jpg.nbytes)),
+                        ("ETag", etag(jpg.seq)),
+                        ("Cache-Control", "no-cache"),
+                    ],
+                )
+            )
+            writer.write(jpg.data)
+        elif status == 304:
+            # A 304 carries the ETag too
+            writer.write(
+                response_head(
+                    304,
+                    [
+                        ("ETag", etag(jpg.seq)),
+                        ("Cache-Control", "no-cache"),
+                        ("Content-length", "0"),
+                    ],
+                )
+            )
+        else:
+            writer.write(response_head(status, [("Content-length", "0")]))
+        await writer.drain()
+
+    async def handle_metrics(self, reader, writer, path, headers):
+        body = metrics.render()
+        writer.write(
+            response_head(
+                200,
+                [
+                    ("Content-type", METRICS_CONTENT_TYPE),
+                    ("Content-length", str(len(body))),
+                ],
+            )
+        )
+        writer.write(body)
+        await writer.drain()
+
+    async def handle_favicon(self, reader, writer, path, headers):
+        writer.write(response_head(404, []))
+        writer.write("favicon is not found".encode())
+        await writer.drain()
+
+    async def handle_index(self, reader, writer, path, headers):
+        body = self.index_html
+        if body is None:
+            writer.write(response_head(404, []))
+            writer.write("index.html is not found".encode())
+        else:
+            writer.write(
+                response_head(
+                    200,
+                    [("Content-type", "text/html"), ("Content-length", str(len(body)))],
+                )
+            )
+            writer.write(body)
+        await writer.drain()
+
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    503: "Service Unavailable",
+}
+
+
+def response_head(status, headers):
+    lines = ["HTTP/1.0 {} {}".format(status, REASONS.get(status, ""))]
+    lines += ["{}: {}".format(name, value) for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def parse_request(data):
+    lines = data.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    path = parts[1] if len(parts) > 1 else "/"
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return path, headers
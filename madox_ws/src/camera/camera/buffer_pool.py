@@ -0,0 +1,43 @@
+import threading
+
+# Buffers kept for reuse. Frames still referenced when the pool is empty
+# make it allocate, buffers beyond this count are then left to the GC.
+POOL_SIZE = 4
+
+
+class FramePool(object):
+    """Preallocated image buffers for the capture thread.
+
+    acquire() returns a free buffer, or None before the first frame when
+    the shape is not known yet and cap.read() has to allocate. A Frame
+    built on a pooled buffer hands it back with give_back() when its last
+    reference is released. Buffers of another shape, after a change of
+    resolution, are dropped instead of reused.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self._shape = None
+        self._free = []
+
+    def acquire(self):
+        with self.lock:
+            if self._free:
+                return self._free.pop()
+        return None
+
+    def adopt(self, image):
+        # Called with every image read, counts the ones cap.read() had to
+        # allocate because no buffer was free or it did not fit
+        with self.lock:
+            if image.shape != self._shape:
+                self._shape = image.shape
+                self._free = []
+            self.allocated += 1
+
+    def give_back(self, image):
+        with self.lock:
+            if image.shape == self._shape and len(self._free) < self.size:
+                self._free.append(image)
@@ -1,6 +1,29 @@
 import cv2
+import numpy as np
 import time
-from threading import Lock
+import threading
+from threading import Condition
+
+from .buffer_pool import FramePool
+from .gst_pipeline import SOURCES, build_pipeline, output_size
+from .log import logger
+from .metrics import metrics
+
+# Pause before retrying after a failed cap.read() so a dead device does not spin
+RETRY_IN_SEC = 0.1
+# Failed reads in a row after which the device is reopened
+MAX_READ_FAILURES = 10
+# A capture thread that did not come back from cap.read() for this long is
+# considered stuck and replaced
+READ_DEADLINE_IN_SEC = 3.0
+# Wait between two attempts to reopen the device, doubled after each failure
+REOPEN_MIN_IN_SEC = 0.5
+REOPEN_MAX_IN_SEC = 30.0
+# Rate of the "camera offline" frame sent to clients while the device is down
+OFFLINE_FPS = 1.0
+# How long the readers of the camera (stream clients, pump, frame bus) wait
+# in wait_frame() before checking the camera is still open
+FRAME_TIMEOUT_IN_SEC = 1.0
 
 
 class Singleton(type):
@@ -12,37 +35,117 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-def gstreamer_pipeline(
-    capture_width=3280,  # Set to your camera's highest resolution
-    capture_height=2464,
-    display_width=224,
-    display_height=224,
-    framerate=120,  # Set the value according to your camera
-    flip_method=0,
-):
-    return (
-        "nvarguscamerasrc ! "
-        "video/x-raw(memory:NVMM), "
-        "width=(int)%d, height=(int)%d, "
-        "format=(string)NV12, framerate=(fraction)%d/1 ! "
-        "nvvidconv flip-method=%d ! "
-        "video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "
-        "videoconvert ! "
-        "video/x-raw, format=(string)BGR ! appsink"
-        % (
-            capture_width,
-            capture_height,
-            framerate,
-            flip_method,
-            display_width,
-            display_height,
-        )
+def offline_image(width, height):
+    image = np.zeros((height, width, 3), np.uint8)
+    text = "camera offline"
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = width / 640
+    (w, h), _ = cv2.getTextSize(text, font, scale, 2)
+    cv2.putText(
+        image,
+        text,
+        ((width - w) // 2, (height + h) // 2),
+        font,
+        scale,
+        (255, 255, 255),
+        2,
+        cv2.LINE_AA,
     )
+    return image
+
+
+class Frame(object):
+    """A captured image tagged with its sequence number and capture time.
+
+    When the image comes from a FramePool the frame is reference counted:
+    the FrameSlot holds one reference while the frame is the latest, and
+    anything reading the pixels must retain() it first and release() it
+    when done. retain() fails once the buffer went back to the pool, the
+    frame is then stale and must be skipped.
+    """
+
+    __slots__ = ("seq", "timestamp", "image", "pool", "refs")
+
+    def __init__(self, seq, timestamp, image, pool=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.image = image
+        self.pool = pool
+        self.refs = 1
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def retain(self):
+        if self.pool is None:
+            return True
+        with self.pool.lock:
+            if self.refs == 0:
+                return False
+            self.refs += 1
+            return True
+
+    def release(self):
+        if self.pool is None:
+            return
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        self.pool.give_back(self.image)
+
+
+class FrameSlot(object):
+    """Holds the most recent frame. Any number of readers can wait on it.
+
+    Readers never consume the frame, they only remember the last sequence
+    number they have seen, so adding a reader does not slow down the others.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._frame = None
+
+    def publish(self, image, timestamp, pool=None):
+        with self._cond:
+            previous = self._frame
+            seq = 1 if previous is None else previous.seq + 1
+            self._frame = Frame(seq, timestamp, image, pool)
+            self._cond.notify_all()
+        if previous is not None:
+            previous.release()
+        return seq
+
+    def latest(self):
+        return self._frame
+
+    def wait(self, last_seq=0, timeout=None):
+        # Returns the newest frame with a sequence number above last_seq, or
+        # None on timeout. Frames published in between are skipped on purpose.
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._frame is not None and self._frame.seq > last_seq,
+                timeout,
+            ):
+                return None
+            return self._frame
 
 
 class Camera(metaclass=Singleton):
-    def __init__(self, source, width, height):
-        self._read_lock = Lock()
+    def __init__(self, source, width, height, pipeline_settings=None):
+        self.frames = FrameSlot()
+        self.pool = FramePool()
+        self._capture_thread = None
+        self._watchdog = None
+        self._running = False
+        # Bumped whenever a capture thread is replaced, an older thread
+        # coming back from cap.read() sees it and exits
+        self._generation = 0
+        self._heartbeat = time.time()
+        self._opening = False
+        self._offline_image = None
+        self.online = True
         # cv2.FONT_HERSHEY_SIMPLEX = 0
         from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -51,48 +154,190 @@ class Camera(metaclass=Singleton):
         self.height = height
         self.scheduler = BackgroundScheduler()
         self.scheduler.start()
-        if self.source == "jetson":
-            capture_device = (
-                "nvarguscamerasrc ! video/x-raw(memory:NVMM), width=(int)"
-                + str(self.width)
-                + ", height=(int)"
-                + str(self.height)
-                + ",format=(string)NV12, framerate=(fraction)15/1 ! nvvidconv ! video/x-raw, format=(string)BGRx ! videoconvert !  appsink"
+        if self.source in SOURCES:
+            # "jetson" is the CSI camera, "test" a GStreamer test pattern
+            self.pipeline = build_pipeline(
+                self.source, self.width, self.height, pipeline_settings
             )
-            self.cap = cv2.VideoCapture(capture_device)
+            # width and height are those of the frames, a 90 degree flip
+            # swaps them
+            self.width, self.height = output_size(width, height, pipeline_settings)
+            logger.info("capture pipeline: {}".format(self.pipeline))
         else:
+            self.pipeline = None
             self.source = int(source)
-            self.cap = cv2.VideoCapture(self.source)
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
-
-        # self.cap = cv2.VideoCapture(
-        #     gstreamer_pipeline(flip_method=0), cv2.CAP_GSTREAMER
-        # )
-        # Comment this and uncomment the code above to change the capture device (e.g.: use otehr cameras)
-        #
-
-    def read(self, sleep_in_sec):
-        self._read_lock.acquire()
-        result = self.cap.read()
-        time.sleep(sleep_in_sec)
-        self._read_lock.release()
-        return result
-
-    def get_frame(self, sleep_in_sec):
-        ret, frame = self.read(sleep_in_sec)
+        self.cap = self._open()
+
+    def _open(self):
+        if self.pipeline is not None:
+            return cv2.VideoCapture(self.pipeline, cv2.CAP_GSTREAMER)
+        cap = cv2.VideoCapture(self.source)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        return cap
+
+    def start(self):
+        # The capture thread is the only owner of self.cap, every other
+        # consumer reads the frames it publishes in self.frames. The
+        # watchdog replaces it when it gets stuck in cap.read().
+        if self._capture_thread is not None:
+            return
+        self._running = True
+        self._heartbeat = time.time()
+        self._start_capture()
+        self._watchdog = threading.Thread(
+            target=self._watchdog_loop, name="camera-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def _start_capture(self, stuck=False):
+        self._generation += 1
+        self._capture_thread = threading.Thread(
+            target=self._capture_loop,
+            args=(self._generation, stuck),
+            name="camera-capture",
+            daemon=True,
+        )
+        self._capture_thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._capture_thread is not None:
+            self._capture_thread.join(timeout=1.0)
+            self._capture_thread = None
+
+    def _capture_loop(self, generation, stuck=False):
+        logger.info("capture thread started")
+        failures = 0
+        # A stuck device is still owned by the thread blocked in its read,
+        # that thread releases it if it ever comes back
+        cap = self._reopen(generation, release=False) if stuck else self.cap
+        while cap is not None and self._running and generation == self._generation:
+            if failures >= MAX_READ_FAILURES or not cap.isOpened():
+                cap = self._reopen(generation)
+                failures = 0
+                continue
+            start = time.time()
+            # Read into a free buffer of the pool, cap.read() only allocates
+            # when none is free or the buffer does not fit
+            buf = self.pool.acquire()
+            ret, image = cap.read() if buf is None else cap.read(image=buf)
+            if generation != self._generation:
+                # Given up on by the watchdog while blocked in the read
+                cap.release()
+                break
+            self._heartbeat = time.time()
+            if not ret:
+                if buf is not None:
+                    self.pool.give_back(buf)
+                failures += 1
+                time.sleep(RETRY_IN_SEC)
+                continue
+            failures = 0
+            if image is not buf:
+                self.pool.adopt(image)
+            now = time.time()
+            metrics.capture.observe(now - start, now)
+            self.frames.publish(image, now, self.pool)
+            self._set_online(True)
+        logger.info("capture thread stopped")
+
+    def _reopen(self, generation, release=True):
+        # Reopens the device with exponential backoff, clients get the
+        # offline frame in the meantime. None when the camera is stopped.
+        self._set_online(False)
+        if release:
+            self.cap.release()
+        delay = REOPEN_MIN_IN_SEC
+        while self._running and generation == self._generation:
+            metrics.reopens += 1
+            logger.info("reopening camera {}".format(self.source))
+            self._opening = True
+            try:
+                cap = self._open()
+            finally:
+                self._opening = False
+                self._heartbeat = time.time()
+            if cap.isOpened():
+                self.cap = cap
+                return cap
+            cap.release()
+            self._wait_offline(delay)
+            delay = min(delay * 2, REOPEN_MAX_IN_SEC)
+        return None
+
+    def _wait_offline(self, delay):
+        end = time.time() + delay
+        while self._running and time.time() < end:
+            self._publish_offline()
+            self._heartbeat = time.time()
+            time.sleep(min(1.0 / OFFLINE_FPS, max(end - time.time(), 0)))
+
+    def _publish_offline(self):
+        if self._offline_image is None:
+            frame = self.frames.latest()
+            height, width = (
+                (self.height, self.width) if frame is None else frame.shape[:2]
+            )
+            self._offline_image = offline_image(width, height)
+        self.frames.publish(self._offline_image, time.time())
+
+    def _set_online(self, online):
+        if online == self.online:
+            return
+        self.online = online
+        metrics.set_online(online)
+        if online:
+            logger.info("camera back online")
+        else:
+            logger.info("camera offline")
+            self._publish_offline()
+
+    def _watchdog_loop(self):
+        while self._running:
+            time.sleep(READ_DEADLINE_IN_SEC / 4)
+            stalled = time.time() - self._heartbeat > READ_DEADLINE_IN_SEC
+            if stalled and not self._opening and self._running:
+                logger.info(
+                    "no frame for {}s, restarting capture".format(READ_DEADLINE_IN_SEC)
+                )
+                self._heartbeat = time.time()
+                self._set_online(False)
+                self._start_capture(stuck=True)
+
+    def read(self, image=None):
+        if image is None:
+            return self.cap.read()
+        return self.cap.read(image=image)
+
+    def wait_frame(self, last_seq=0, timeout=None):
+        return self.frames.wait(last_seq, timeout)
+
+    def latest_frame(self):
+        # Newest Frame without waiting, None before the first capture
+        return self.frames.latest()
+
+    def get_frame(self, timeout=None):
+        # Latest captured image, shared with every other reader: copy it
+        # before drawing on it
+        frame = self.frames.wait(0, timeout)
         # TODO: add parameters to stream in grayscale
         # frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        if not ret:
+        if frame is None or not frame.retain():
             return None
-        return frame
+        # The pooled buffer is reused by the capture thread, callers get
+        # their own copy
+        try:
+            return frame.image.copy()
+        finally:
+            frame.release()
 
-    def read_in_jpeg(self, sleep_in_sec, f):
-        ret, frame = self.read(sleep_in_sec)
+    def read_in_jpeg(self, timeout=None):
+        frame = self.get_frame(timeout)
         # self.drawCrosshair(frame)
         # self.drawOverlay(frame, f)
 
-        if not ret:
+        if frame is None:
             return None
         ret, jpg = cv2.imencode(".jpg", frame)
 
@@ -101,7 +346,10 @@ class Camera(metaclass=Singleton):
         return jpg
 
     def is_opened(self):
-        return self.cap.isOpened()
+        # While the capture is supervised the camera counts as open, clients
+        # keep their connection and get the offline frame during outages
+        return self._running or self.cap.isOpened()
 
     def release(self):
+        self.stop()
         self.cap.release()
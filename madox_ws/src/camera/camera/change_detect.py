@@ -0,0 +1,52 @@
+import threading
+
+import cv2
+
+# Thumbnail compared between frames, small enough to cost next to nothing
+THUMBNAIL_SIZE = (32, 24)
+# Mean absolute difference in grey levels (0-255) below which a frame is
+# considered unchanged
+DEFAULT_THRESHOLD = 2.0
+# An unchanged picture is still encoded this often, so the overlay stays
+# current and clients see the stream is alive
+KEEPALIVE_IN_SEC = 1.0
+
+
+class ChangeDetector(object):
+    """Tells whether a frame differs from the one last encoded.
+
+    Each frame is reduced to a small greyscale thumbnail, computed once per
+    frame whatever the number of keys asking, and compared to the
+    thumbnail of the frame behind the cached JPEG with a mean absolute
+    difference. Comparing with the encoded frame rather than the previous
+    one means a slow drift is still noticed.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, keepalive=KEEPALIVE_IN_SEC):
+        self.threshold = threshold
+        self.keepalive = keepalive
+        self.skipped = 0
+        self._seq = None
+        self._thumbnail = None
+        self._lock = threading.Lock()
+
+    def thumbnail(self, frame):
+        with self._lock:
+            if self._seq == frame.seq:
+                return self._thumbnail
+        small = cv2.resize(frame.image, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        with self._lock:
+            self._seq, self._thumbnail = frame.seq, small
+        return small
+
+    def unchanged(self, timestamp, reference, frame):
+        # timestamp and reference are those of the frame last encoded
+        if reference is None or frame.timestamp - timestamp >= self.keepalive:
+            return False
+        difference = cv2.mean(cv2.absdiff(reference, self.thumbnail(frame)))[0]
+        if difference < self.threshold:
+            self.skipped += 1
+            return True
+        return False
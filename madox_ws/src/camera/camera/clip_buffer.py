@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import deque
+
+from .framing import part_header
+from .log import logger
+
+PRE_SECONDS = 10.0
+POST_SECONDS = 3.0
+BUDGET_BYTES = 64 * 1024 * 1024
+CLIP_DIR = "clips"
+
+
+class ClipBuffer(object):
+    """Ring buffer of the last seconds of encoded frames.
+
+    push() is a sink of the EncodePump: it keeps references to the shared
+    EncodedFrame objects, never copies, and evicts the oldest frames once
+    they are older than pre_seconds or the buffer goes over its memory
+    budget. trigger() takes what is buffered, keeps collecting frames for
+    post_seconds and then hands the whole clip to the SnapshotWriter as one
+    multipart MJPEG file, so the moment before the trigger is on disk too.
+    """
+
+    def __init__(
+        self,
+        writer,
+        pre_seconds=PRE_SECONDS,
+        post_seconds=POST_SECONDS,
+        budget_bytes=BUDGET_BYTES,
+    ):
+        self.writer = writer
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.budget_bytes = budget_bytes
+        self._frames = deque()
+        self._bytes = 0
+        self._recording = []
+        # Names of the clips triggered so far
+        self._names = set()
+        self._lock = threading.Lock()
+
+    @property
+    def buffered_bytes(self):
+        return self._bytes
+
+    @property
+    def buffered_seconds(self):
+        frames = self._frames
+        if len(frames) < 2:
+            return 0.0
+        return frames[-1].timestamp - frames[0].timestamp
+
+    def push(self, encoded):
+        finished = []
+        with self._lock:
+            self._frames.append(encoded)
+            self._bytes += encoded.nbytes
+            oldest = encoded.timestamp - self.pre_seconds
+            while self._frames and (
+                self._frames[0].timestamp < oldest or self._bytes > self.budget_bytes
+            ):
+                self._bytes -= self._frames.popleft().nbytes
+            for clip in self._recording:
+                clip[2].append(encoded)
+                if encoded.timestamp >= clip[1]:
+                    finished.append(clip)
+            if finished:
+                self._recording = [c for c in self._recording if c not in finished]
+        for name, _, frames in finished:
+            self._save(name, frames)
+
+    def trigger(self, name=None):
+        if name is None:
+            now = time.time()
+            name = "{}.{:03d}".format(
+                time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+                int(now % 1 * 1000),
+            )
+        with self._lock:
+            # A clip never overwrites an earlier one, even when triggered
+            # twice within a millisecond or given the same name
+            base, count = name, 1
+            while name in self._names:
+                count += 1
+                name = "{}-{}".format(base, count)
+            self._names.add(name)
+            frames = list(self._frames)
+            deadline = time.time() + self.post_seconds
+            self._recording.append((name, deadline, frames))
+        logger.info(
+            "clip {} triggered with {} buffered frames".format(name, len(frames))
+        )
+        return name
+
+    def _save(self, name, frames):
+        parts = []
+        for encoded in frames:
+            parts.append(part_header(encoded.nbytes, encoded.timestamp))
+            parts.append(encoded.data)
+            parts.append(b"\r\n")
+        self.writer.submit(parts, "{}/{}.mjpg".format(CLIP_DIR, name))
+        logger.info("clip {} saved with {} frames".format(name, len(frames)))
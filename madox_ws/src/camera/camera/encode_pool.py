@@ -0,0 +1,297 @@
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from .encoder import encode_jpeg
+from .log import logger
+
+# Frames in flight per worker: one being encoded, one waiting
+SLOTS_PER_WORKER = 2
+# encode() gives up after this and encodes in the node, a dead worker must
+# not hang the streams
+ENCODE_TIMEOUT_IN_SEC = 2.0
+# The workers are started again this many times after one of them died,
+# then the pool is disabled and every frame is encoded in the node
+MAX_RESTARTS = 3
+# How often the result collector checks whether its queue was replaced and
+# whether the oldest frame is overdue
+COLLECT_TIMEOUT_IN_SEC = 0.5
+
+
+def _worker(tasks, results):
+    # Runs in the pool processes: reads the image from the shared memory
+    # slot named in the task and sends back only the JPEG bytes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    attached = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, name, shape, quality = task
+        try:
+            shm = attached.get(name)
+            if shm is None:
+                shm = attached[name] = shared_memory.SharedMemory(name=name)
+            image = np.ndarray(shape, np.uint8, buffer=shm.buf)
+            ret, jpg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            del image
+        except Exception:
+            # The slot was replaced after a restart of the pool
+            ret = False
+        results.put((task_id, jpg.tobytes() if ret else None))
+    for shm in attached.values():
+        shm.close()
+
+
+class _Task(object):
+    __slots__ = ("task_id", "seq", "shm", "submitted", "data", "done", "future")
+
+    def __init__(self, task_id, seq, shm):
+        self.task_id = task_id
+        self.seq = seq
+        self.shm = shm
+        self.submitted = time.monotonic()
+        self.data = None
+        self.done = False
+        self.future = Future()
+
+
+class EncodePool(object):
+    """JPEG encoding in worker processes.
+
+    submit(seq, image, quality) copies the image into a free shared memory
+    slot, nothing is pickled but the slot name and shape, and returns a
+    Future of (seq, jpeg bytes). Futures complete in submission order even
+    when a later frame is encoded first, so a caller reading them one by
+    one gets the frames in sequence. submit() blocks while every slot is in
+    use, which bounds the memory and the latency, and raises queue.Empty
+    when none frees up within ENCODE_TIMEOUT_IN_SEC. Every Future completes:
+    a frame the workers do not return within ENCODE_TIMEOUT_IN_SEC is
+    abandoned, its slot replaced, and its Future gets None for the bytes.
+
+    try_submit() is what the EncodeCache calls, it returns None when the
+    caller should encode the frame itself. encode() is the blocking form,
+    a frame not returned in time is encoded in the node instead.
+    When a worker died, all of them start over on new queues, since a
+    process killed while holding a queue's lock blocks that queue for good.
+    After MAX_RESTARTS the pool is disabled and encode() encodes in the
+    node.
+    """
+
+    def __init__(self, workers=2, slots=None):
+        self.workers = workers
+        self.restarts = 0
+        self.disabled = False
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = []
+        self._tasks = None
+        self._results = None
+        # Slots are created on first use and grown when a larger frame comes
+        self._free = queue.Queue()
+        for _ in range(slots or workers * SLOTS_PER_WORKER):
+            self._free.put(None)
+        self._pending = {}
+        self._order = deque()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._workers_lock = threading.Lock()
+
+    def start(self):
+        self._start_workers()
+        logger.info("encode pool started with {} workers".format(self.workers))
+
+    def _start_workers(self):
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._processes = [
+            self._context.Process(
+                target=_worker,
+                args=(self._tasks, self._results),
+                name="jpeg-encoder-{}".format(i),
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+        threading.Thread(
+            target=self._collect,
+            args=(self._results,),
+            name="jpeg-encoder-results",
+            daemon=True,
+        ).start()
+
+    def submit(self, seq, image, quality):
+        return self._submit(seq, image, quality).future
+
+    def _submit(self, seq, image, quality):
+        shm = self._free.get(timeout=ENCODE_TIMEOUT_IN_SEC)
+        if shm is None or shm.size < image.nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+        view = np.ndarray(image.shape, np.uint8, buffer=shm.buf)
+        np.copyto(view, image)
+        del view
+        with self._lock:
+            task = _Task(self._next_id, seq, shm)
+            self._next_id += 1
+            self._pending[task.task_id] = task
+            self._order.append(task)
+            # Under the lock, so a restart cannot swap the queue in between
+            self._tasks.put((task.task_id, shm.name, image.shape, int(quality)))
+        return task
+
+    def try_submit(self, seq, image, quality):
+        self._check_workers()
+        if self.disabled:
+            return None
+        try:
+            return self.submit(seq, image, quality)
+        except queue.Empty:
+            logger.warning("encode pool has no free slot for frame {}".format(seq))
+            return None
+
+    def encode(self, image, quality, seq=0):
+        self._check_workers()
+        if self.disabled:
+            return encode_jpeg(image, quality)
+        try:
+            task = self._submit(seq, image, quality)
+        except queue.Empty:
+            logger.warning("encode pool has no free slot for frame {}".format(seq))
+            return encode_jpeg(image, quality)
+        try:
+            data = task.future.result(ENCODE_TIMEOUT_IN_SEC)[1]
+        except TimeoutError:
+            logger.warning("encode pool did not return frame {}".format(seq))
+            self._abandon(task)
+            self._check_workers()
+            data = None
+        if data is None:
+            return encode_jpeg(image, quality)
+        return data
+
+    def _check_workers(self):
+        with self._workers_lock:
+            dead = [p for p in self._processes if not p.is_alive()]
+            if self.disabled or not dead:
+                return
+            for process in dead:
+                logger.warning(
+                    "{} exited with {}".format(process.name, process.exitcode)
+                )
+            if self.restarts >= MAX_RESTARTS:
+                logger.error("encode workers keep dying, encoding in the node")
+                self.disabled = True
+                self._stop_workers()
+                return
+            self.restarts += 1
+            self._stop_workers()
+            with self._lock:
+                lost = list(self._order)
+                self._order.clear()
+                self._pending.clear()
+                self._start_workers()
+            for task in lost:
+                if not task.done:
+                    self._replace_slot(task)
+            # Frames that were not returned are encoded by their callers
+            self._resolve(lost)
+            logger.info("encode pool restarted")
+
+    def _stop_workers(self):
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=1.0)
+        # A dead worker may hold their locks, exit must not wait on them
+        self._tasks.cancel_join_thread()
+        self._results.cancel_join_thread()
+
+    def _abandon(self, task):
+        # The frame is not waited for any more, and frames submitted after
+        # it must not wait for it either
+        with self._lock:
+            if self._pending.pop(task.task_id, None) is None:
+                # Returned meanwhile, or dropped by a restart of the pool
+                return
+            self._order.remove(task)
+            ready = self._ready()
+        self._replace_slot(task)
+        self._resolve([task] + ready)
+
+    def _expire(self):
+        with self._lock:
+            oldest = self._order[0] if self._order else None
+        if oldest is None:
+            return
+        if time.monotonic() - oldest.submitted < ENCODE_TIMEOUT_IN_SEC:
+            return
+        logger.warning("encode pool did not return frame {}".format(oldest.seq))
+        self._abandon(oldest)
+        self._check_workers()
+
+    def _replace_slot(self, task):
+        # A worker may still be reading the slot, a new one replaces it
+        task.shm.close()
+        task.shm.unlink()
+        self._free.put(None)
+
+    def _ready(self):
+        # Called with the lock held: the done tasks at the head of the order
+        ready = []
+        while self._order and self._order[0].done:
+            ready.append(self._order.popleft())
+        return ready
+
+    def _resolve(self, ready):
+        for task in ready:
+            task.future.set_result((task.seq, task.data))
+
+    def _collect(self, results):
+        # Ends when the pool restarted on new queues or is closed
+        while results is self._results:
+            self._expire()
+            try:
+                item = results.get(timeout=COLLECT_TIMEOUT_IN_SEC)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            task_id, data = item
+            with self._lock:
+                task = self._pending.pop(task_id, None)
+                if task is None:
+                    # Abandoned by encode(), its slot was replaced already
+                    continue
+                task.data = data
+                task.done = True
+                ready = self._ready()
+            self._free.put(task.shm)
+            self._resolve(ready)
+
+    def close(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=1.0)
+        self._stop_workers()
+        self._results.put(None)
+        while True:
+            try:
+                shm = self._free.get_nowait()
+            except queue.Empty:
+                break
+            if shm is not None:
+                shm.close()
+                shm.unlink()
@@ -0,0 +1,307 @@
+import functools
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+
+from .camera import FRAME_TIMEOUT_IN_SEC
+from .framing import part_header
+from .log import logger
+from .metrics import metrics
+
+# Entries not requested for this long are dropped from the cache
+IDLE_TIMEOUT_IN_SEC = 10.0
+DEFAULT_QUALITY = 90
+
+# Timestamps of frames captured at a steady rate still jitter a little
+FPS_TOLERANCE_IN_SEC = 0.005
+# Overlay mode of streams that asked for the bare picture
+PLAIN_MODE = -1
+
+# Everything that changes the bytes of an encoded frame: overlay mode, JPEG
+# quality, scale factor relative to the captured resolution and the highest
+# frame rate encoded, 0 for every frame
+StreamKey = namedtuple("StreamKey", ["mode", "quality", "scale", "fps"], defaults=(0,))
+
+
+class EncodedFrame(object):
+    """JPEG bytes of one composited frame, shared by every client."""
+
+    __slots__ = ("seq", "timestamp", "key", "data", "_part_header")
+
+    def __init__(self, seq, timestamp, key, data):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.key = key
+        self.data = data
+        self._part_header = None
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    @property
+    def part_header(self):
+        # Built by the first client sending the frame, reused by the others
+        if self._part_header is None:
+            self._part_header = part_header(self.nbytes)
+        return self._part_header
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class _Entry(object):
+    __slots__ = (
+        "lock",
+        "encoded",
+        "seq",
+        "timestamp",
+        "latest",
+        "thumbnail",
+        "canvas",
+        "last_used",
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Newest frame encoded
+        self.encoded = None
+        # Newest frame submitted and the Future of its EncodedFrame, it may
+        # still be in the EncodePool
+        self.seq = 0
+        self.timestamp = 0.0
+        self.latest = _done(None)
+        self.thumbnail = None
+        # Image the overlay is drawn on, reused from frame to frame
+        self.canvas = None
+        self.last_used = time.time()
+
+
+def encode_jpeg(image, quality=DEFAULT_QUALITY):
+    ret, jpg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ret:
+        return None
+    return jpg.tobytes()
+
+
+def scale_image(image, scale, out=None):
+    # Never returns the captured frame itself, it is shared and must not be
+    # drawn on. The result goes into out when it has the right size.
+    if scale == 1.0:
+        if out is None or out.shape != image.shape:
+            return image.copy()
+        np.copyto(out, image)
+        return out
+    return cv2.resize(
+        image, None, out, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+    )
+
+
+class EncodeCache(object):
+    """Composites and encodes each frame once per key.
+
+    The key is a StreamKey. The frame is scaled to key.scale, then
+    render(image, key) draws on this private copy and returns the image to
+    encode at key.quality, or None to skip the frame. The first client asking
+    for a (frame, key) pair does the work, the others wait on the entry lock
+    and get the same EncodedFrame. With key.fps set, frames arriving sooner
+    than 1 / fps after the cached one get the cached one back. With a
+    ChangeDetector, so do frames that look the same as the cached one.
+
+    With an EncodePool the JPEG encoding runs in its worker processes.
+    submit() then only renders the frame under the entry lock and returns a
+    Future, the caller can submit the next frame while this one is in a
+    worker. Callers asking for a frame in flight share its Future.
+    """
+
+    def __init__(
+        self,
+        render,
+        idle_timeout=IDLE_TIMEOUT_IN_SEC,
+        detector=None,
+        encode_pool=None,
+    ):
+        self._render = render
+        self._detector = detector
+        self._encode_pool = encode_pool
+        self._idle_timeout = idle_timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def _entry(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            # Variants nobody watches any more are torn down with their frame
+            if now - self._last_prune > self._idle_timeout:
+                self._last_prune = now
+                self._prune(now)
+            entry.last_used = now
+            return entry
+
+    def _prune(self, now):
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self._idle_timeout:
+                del self._entries[key]
+
+    @property
+    def depth(self):
+        # Frames worth keeping in flight with submit()
+        return 1 if self._encode_pool is None else self._encode_pool.workers
+
+    def get(self, key, frame):
+        return self.submit(key, frame).result()
+
+    def submit(self, key, frame):
+        entry = self._entry(key)
+        with entry.lock:
+            if not frame.retain():
+                # The buffer went back to the capture pool, a newer frame
+                # is on its way
+                return entry.latest
+            try:
+                return self._submit(key, frame, entry)
+            finally:
+                frame.release()
+
+    def _submit(self, key, frame, entry):
+        if entry.seq >= frame.seq:
+            return entry.latest
+        if entry.seq and key.fps:
+            due = entry.timestamp + 1.0 / key.fps - FPS_TOLERANCE_IN_SEC
+            if frame.timestamp < due:
+                return entry.latest
+        detector = self._detector
+        if detector is not None and entry.seq:
+            if detector.unchanged(entry.timestamp, entry.thumbnail, frame):
+                return entry.latest
+        start = time.time()
+        entry.canvas = scale_image(frame.image, key.scale, entry.canvas)
+        image = self._render(entry.canvas, key)
+        if image is None:
+            return _done(None)
+        rendered = time.time()
+        metrics.overlay.observe(rendered - start, rendered)
+        entry.seq = frame.seq
+        entry.timestamp = frame.timestamp
+        if detector is not None:
+            entry.thumbnail = detector.thumbnail(frame)
+        result = entry.latest = Future()
+        finish = functools.partial(
+            self._finish, result, entry, key, frame.seq, frame.timestamp, rendered
+        )
+        pool = self._encode_pool
+        # The pool copies the image, the canvas is free once submitted
+        encoding = (
+            None if pool is None else pool.try_submit(frame.seq, image, key.quality)
+        )
+        if encoding is None:
+            finish(encode_jpeg(image, key.quality))
+        else:
+            encoding.add_done_callback(lambda f: finish(f.result()[1]))
+        return result
+
+    def _finish(self, result, entry, key, seq, timestamp, rendered, data):
+        encoded = None
+        if data is not None:
+            # From the end of the render, waiting for a worker included
+            metrics.encode.observe(time.time() - rendered)
+            metrics.encode_size.observe(len(data))
+            encoded = EncodedFrame(seq, timestamp, key, data)
+            with self._lock:
+                if entry.encoded is None or entry.encoded.seq < seq:
+                    entry.encoded = encoded
+        result.set_result(encoded)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def latest(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else entry.encoded
+
+
+class EncodePump(threading.Thread):
+    """Feeds encoded frames to consumers that are not HTTP clients.
+
+    Every captured frame is submitted to the shared EncodeCache with the
+    key returned by key(), so the work is shared with live clients on the
+    same key, and the EncodedFrame is passed to each sink in capture order.
+    With an EncodePool the pump does not wait for a frame before submitting
+    the next one, up to encoder.depth frames are in the workers. Sinks are
+    called on the pump thread and must not block. Nothing is encoded while
+    there are no sinks, unless prefetch() returns True: stream clients on
+    the same key then find their frames in flight already. An error in the
+    encoding or in a sink is logged and the pump goes on with the next
+    frame.
+    """
+
+    def __init__(self, camera, encoder, key, prefetch=None):
+        super().__init__(name="encode-pump", daemon=True)
+        self.camera = camera
+        self.encoder = encoder
+        self.key = key
+        self.prefetch = prefetch
+        self._sinks = []
+        self._running = True
+        self._delivered = 0
+
+    def add_sink(self, sink):
+        self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        self._sinks = [s for s in self._sinks if s is not sink]
+
+    def stop(self):
+        self._running = False
+
+    def _wanted(self):
+        return bool(self._sinks) or (self.prefetch is not None and self.prefetch())
+
+    def run(self):
+        seq = 0
+        in_flight = deque()
+        while self._running and self.camera.is_opened():
+            frame = self.camera.wait_frame(seq, FRAME_TIMEOUT_IN_SEC)
+            if frame is not None:
+                seq = frame.seq
+                if self._wanted():
+                    try:
+                        in_flight.append(self.encoder.submit(self.key(), frame))
+                    except Exception:
+                        logger.exception(
+                            "encode pump cannot encode frame {}".format(seq)
+                        )
+            # Waits for the oldest frame only when the pool is full or the
+            # camera went quiet
+            while in_flight and (
+                in_flight[0].done()
+                or len(in_flight) > self.encoder.depth
+                or frame is None
+            ):
+                self._deliver(in_flight.popleft().result())
+        while in_flight:
+            self._deliver(in_flight.popleft().result())
+
+    def _deliver(self, encoded):
+        # A frame skipped by the cache comes back as the previous one, the
+        # sinks get each frame once
+        if encoded is None or encoded.seq <= self._delivered:
+            return
+        self._delivered = encoded.seq
+        for sink in self._sinks:
+            try:
+                sink(encoded)
+            except Exception:
+                logger.exception("encode pump sink {!r} failed".format(sink))
@@ -0,0 +1,32 @@
+URL_PATH_MJPG = "/camera.mjpg"
+BOUNDARY = "--jpgboundary"
+MULTIPART_TYPE = "multipart/x-mixed-replace; boundary=" + BOUNDARY
+
+
+def part_header(nbytes, timestamp=None):
+    # Everything in front of the JPEG bytes of one part of the multipart
+    # stream, built once per encoded frame and shared by its clients. The
+    # recorder and clip buffer also stamp the part with its capture time.
+    lines = [BOUNDARY, "Content-type: image/jpeg", "Content-length: {}".format(nbytes)]
+    if timestamp is not None:
+        lines.append("X-Timestamp: {:.6f}".format(timestamp))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def send_parts(sock, parts):
+    """Sends the buffers in order with as few sendmsg() calls as possible.
+
+    The buffers go to the kernel as they are, the JPEG bytes are never
+    joined to their header. A partial send, when the socket buffer fills,
+    resumes from the first byte not sent. Returns the number of bytes sent.
+    """
+    buffers = [memoryview(part).cast("B") for part in parts]
+    total = 0
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        total += sent
+        while buffers and sent >= buffers[0].nbytes:
+            sent -= buffers.pop(0).nbytes
+        if sent:
+            buffers[0] = buffers[0][sent:]
+    return total
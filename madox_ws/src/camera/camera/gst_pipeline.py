@@ -0,0 +1,107 @@
+# Values used when a setting is not given. sensor_mode -1 lets the Argus
+# daemon pick the mode from the requested size and framerate.
+DEFAULT_SETTINGS = {
+    "sensor_id": 0,
+    "sensor_mode": -1,
+    "framerate": 15,
+    "flip_method": 0,
+    "format": "BGR",
+    "appsink_drop": True,
+    "appsink_max_buffers": 1,
+    "appsink_sync": False,
+    "test_pattern": "ball",
+}
+
+# Sources a pipeline can be built for, other --device values are V4L2
+# device numbers opened directly by OpenCV
+SOURCES = ("jetson", "test")
+# flip_method uses the nvvidconv numbering. videoflip, used by the "test"
+# source, numbers the same operations differently.
+VIDEOFLIP_METHODS = {
+    0: 0,  # none
+    1: 3,  # 90 degrees counterclockwise
+    2: 2,  # 180 degrees
+    3: 1,  # 90 degrees clockwise
+    4: 4,  # horizontal flip
+    5: 7,  # upper right diagonal
+    6: 5,  # vertical flip
+    7: 6,  # upper left diagonal
+}
+# Flips that transpose the picture, the frames are then height x width
+TRANSPOSING_FLIPS = (1, 3, 5, 7)
+
+
+def appsink(settings):
+    # By default the sink keeps a single buffer, drops the older ones and
+    # hands it over as soon as it arrives: the capture thread always gets
+    # the newest picture instead of working through a queue of stale ones
+    return "appsink drop={} max-buffers={} sync={}".format(
+        str(bool(settings["appsink_drop"])).lower(),
+        int(settings["appsink_max_buffers"]),
+        str(bool(settings["appsink_sync"])).lower(),
+    )
+
+
+def _settings(settings):
+    s = dict(DEFAULT_SETTINGS)
+    s.update(settings or {})
+    if int(s["flip_method"]) not in VIDEOFLIP_METHODS:
+        raise ValueError("flip_method must be 0-7, not {}".format(s["flip_method"]))
+    return s
+
+
+def output_size(width, height, settings=None):
+    # Size of the frames the pipeline delivers for a capture of width x height
+    if int(_settings(settings)["flip_method"]) in TRANSPOSING_FLIPS:
+        return height, width
+    return width, height
+
+
+def build_pipeline(source, width, height, settings=None):
+    """Pipeline string for source "jetson" (CSI camera) or "test".
+
+    settings overrides DEFAULT_SETTINGS. The "test" source is a live
+    videotestsrc with the same caps and appsink, for benchmarking capture
+    without a camera.
+    """
+    s = _settings(settings)
+    if source == "jetson":
+        mode = (
+            ""
+            if s["sensor_mode"] < 0
+            else " sensor-mode={}".format(int(s["sensor_mode"]))
+        )
+        head = (
+            "nvarguscamerasrc sensor-id={sensor_id}{mode} ! "
+            "video/x-raw(memory:NVMM), width=(int){width}, height=(int){height}, "
+            "format=(string)NV12, framerate=(fraction){framerate}/1 ! "
+            "nvvidconv flip-method={flip} ! "
+            "video/x-raw, format=(string)BGRx ! "
+        ).format(
+            sensor_id=int(s["sensor_id"]),
+            mode=mode,
+            width=width,
+            height=height,
+            framerate=int(s["framerate"]),
+            flip=int(s["flip_method"]),
+        )
+    elif source == "test":
+        head = (
+            "videotestsrc is-live=true pattern={pattern} ! "
+            "video/x-raw, width=(int){width}, height=(int){height}, "
+            "framerate=(fraction){framerate}/1 ! "
+        ).format(
+            pattern=s["test_pattern"],
+            width=width,
+            height=height,
+            framerate=int(s["framerate"]),
+        )
+        if int(s["flip_method"]):
+            head += "videoflip method={} ! ".format(
+                VIDEOFLIP_METHODS[int(s["flip_method"])]
+            )
+    else:
+        raise ValueError("unknown pipeline source {!r}".format(source))
+    return head + "videoconvert ! video/x-raw, format=(string){} ! {}".format(
+        s["format"], appsink(s)
+    )
@@ -0,0 +1,86 @@
+import array
+
+from builtin_interfaces.msg import Time
+from rclpy.qos import HistoryPolicy, QoSProfile, ReliabilityPolicy
+from sensor_msgs.msg import CompressedImage
+
+from .encoder import FPS_TOLERANCE_IN_SEC
+
+# Node parameters, declared as compressed_image.<name>. max_rate is in
+# messages per second, 0 publishes every frame the pump encodes.
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "topic": "camera/image/compressed",
+    "frame_id": "camera",
+    "max_rate": 5.0,
+}
+# How often the publisher checks whether anybody subscribed
+SUBSCRIBER_CHECK_IN_SEC = 1.0
+
+
+def stamp(timestamp):
+    sec = int(timestamp)
+    return Time(sec=sec, nanosec=int((timestamp - sec) * 1e9))
+
+
+class CompressedImagePublisher(object):
+    """Publishes the frames of the EncodePump as sensor_msgs/CompressedImage.
+
+    The JPEG bytes are the pump's: the picture of the current display config
+    on the best tier, shared with the clip buffer, the recorder and a pilot
+    streaming at that tier. With none of them active the pump encodes the
+    frames for the topic alone. The publisher is a sink of the pump only
+    while the topic has subscribers, so with nobody listening the pump does
+    no work for it. QoS is best effort with a depth of 1: a subscriber that
+    falls behind gets the newest frame, not a queue.
+    """
+
+    def __init__(self, node, pump, settings):
+        self.node = node
+        self.pump = pump
+        self.frame_id = settings["frame_id"]
+        self.max_rate = settings["max_rate"]
+        qos = QoSProfile(
+            history=HistoryPolicy.KEEP_LAST,
+            depth=1,
+            reliability=ReliabilityPolicy.BEST_EFFORT,
+        )
+        self._publisher = node.create_publisher(CompressedImage, settings["topic"], qos)
+        self._last_timestamp = 0.0
+        self._active = False
+        # Bound once, remove_sink() looks for this very object
+        self._sink = self.push
+        self._timer = node.create_timer(SUBSCRIBER_CHECK_IN_SEC, self.update)
+
+    def update(self):
+        # max_rate can be changed at run time with ros2 param set
+        self.max_rate = self.node.get_parameter("compressed_image.max_rate").value
+        subscribed = self._publisher.get_subscription_count() > 0
+        if subscribed == self._active:
+            return
+        self._active = subscribed
+        if subscribed:
+            self.pump.add_sink(self._sink)
+        else:
+            self.pump.remove_sink(self._sink)
+
+    def push(self, encoded):
+        # Pump sink, called for every encoded frame while subscribed
+        if self.max_rate > 0:
+            interval = 1.0 / self.max_rate - FPS_TOLERANCE_IN_SEC
+            if encoded.timestamp - self._last_timestamp < interval:
+                return
+        self._last_timestamp = encoded.timestamp
+        msg = CompressedImage()
+        # Stamped with the capture time, not the time of publishing
+        msg.header.stamp = stamp(encoded.timestamp)
+        msg.header.frame_id = self.frame_id
+        msg.format = "jpeg"
+        # An array is taken as it is, bytes would be checked value by value
+        msg.data = array.array("B", encoded.data)
+        self._publisher.publish(msg)
+
+    def destroy(self):
+        self.pump.remove_sink(self._sink)
+        self.node.destroy_timer(self._timer)
+        self.node.destroy_publisher(self._publisher)
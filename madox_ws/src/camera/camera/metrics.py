@@ -0,0 +1,205 @@
+import bisect
+import threading
+import time
+
+URL_PATH_METRICS = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Histograms cover the last WINDOW_IN_SEC, in SLOTS slices that are reset
+# as they come round again
+WINDOW_IN_SEC = 60.0
+SLOTS = 6
+
+SECONDS_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+BYTES_BUCKETS = (8e3, 16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6)
+
+
+class Histogram(object):
+    """Histogram of the values observed during the last window seconds.
+
+    Memory is fixed: one row of bucket counts per time slice, a slice is
+    cleared when it is reused. Counts are not cumulative over the process
+    lifetime like a Prometheus histogram usually is, they describe the
+    window, which is what matters on a dashboard for a robot.
+    """
+
+    def __init__(self, name, help, buckets, window=WINDOW_IN_SEC, slots=SLOTS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._slice = window / slots
+        self._counts = [[0] * (len(self.buckets) + 1) for _ in range(slots)]
+        self._sums = [0.0] * slots
+        self._epochs = [-1] * slots
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def observe(self, value, now=None):
+        epoch = int((time.time() if now is None else now) / self._slice)
+        i = epoch % len(self._epochs)
+        with self._lock:
+            if self._epochs[i] != epoch:
+                self._epochs[i] = epoch
+                self._counts[i] = [0] * (len(self.buckets) + 1)
+                self._sums[i] = 0.0
+            self._counts[i][bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[i] += value
+
+    def snapshot(self, now=None):
+        # (per bucket counts, sum) over the slices still in the window
+        epoch = int((time.time() if now is None else now) / self._slice)
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        with self._lock:
+            for i, slice_epoch in enumerate(self._epochs):
+                if epoch - slice_epoch < len(self._epochs):
+                    counts = [a + b for a, b in zip(counts, self._counts[i])]
+                    total += self._sums[i]
+        return counts, total
+
+    def rate(self, now=None):
+        # Observations per second over the slices still in the window
+        now = time.time() if now is None else now
+        counts, _ = self.snapshot(now)
+        oldest = (int(now / self._slice) - len(self._epochs) + 1) * self._slice
+        return sum(counts) / max(now - max(oldest, self._started), 1e-6)
+
+    def render(self, labels=""):
+        counts, total = self.snapshot()
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(
+                '{}_bucket{{{}{}le="{:g}"}} {}'.format(
+                    self.name, labels, sep, bound, cumulative
+                )
+            )
+        cumulative += counts[-1]
+        lines.append(
+            '{}_bucket{{{}{}le="+Inf"}} {}'.format(self.name, labels, sep, cumulative)
+        )
+        suffix = "{{{}}}".format(labels) if labels else ""
+        lines.append("{}_sum{} {}".format(self.name, suffix, total))
+        lines.append("{}_count{} {}".format(self.name, suffix, cumulative))
+        return lines
+
+
+def header(name, help, kind):
+    return ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, kind)]
+
+
+class PipelineMetrics(object):
+    """Where the time goes in the camera node, rendered for /metrics.
+
+    The capture thread, the EncodeCache and every StreamSession report to
+    the module level instance. Clients are tracked while they are connected
+    and forgotten when they leave.
+    """
+
+    def __init__(self):
+        self.capture = Histogram(
+            "camera_read_seconds", "Time spent in Camera.read", SECONDS_BUCKETS
+        )
+        self.overlay = Histogram(
+            "camera_overlay_seconds",
+            "Time spent scaling and drawing the overlay",
+            SECONDS_BUCKETS,
+        )
+        self.encode = Histogram(
+            "camera_encode_seconds", "Time spent encoding JPEG", SECONDS_BUCKETS
+        )
+        self.encode_size = Histogram(
+            "camera_encode_bytes", "Size of encoded JPEG frames", BYTES_BUCKETS
+        )
+        self.reopens = 0
+        self._offline_since = None
+        self._offline_total = 0.0
+        self._sessions = set()
+        self._lock = threading.Lock()
+
+    def set_online(self, online):
+        now = time.time()
+        with self._lock:
+            if online and self._offline_since is not None:
+                self._offline_total += now - self._offline_since
+                self._offline_since = None
+            elif not online and self._offline_since is None:
+                self._offline_since = now
+
+    def offline_seconds(self):
+        with self._lock:
+            total = self._offline_total
+            if self._offline_since is not None:
+                total += time.time() - self._offline_since
+        return total
+
+    def capture_fps(self):
+        return self.capture.rate()
+
+    def add_session(self, session):
+        with self._lock:
+            self._sessions.add(session)
+
+    def remove_session(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def session_count(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def render(self):
+        lines = header("camera_capture_fps", "Frames captured per second", "gauge")
+        lines.append("camera_capture_fps {:.2f}".format(self.capture_fps()))
+        lines += header(
+            "camera_offline_seconds_total",
+            "Time the camera was not delivering frames",
+            "counter",
+        )
+        lines.append(
+            "camera_offline_seconds_total {:.3f}".format(self.offline_seconds())
+        )
+        lines += header(
+            "camera_reopen_total", "Attempts to reopen the camera", "counter"
+        )
+        lines.append("camera_reopen_total {}".format(self.reopens))
+        for histogram in (self.capture, self.overlay, self.encode, self.encode_size):
+            lines += header(histogram.name, histogram.help, "histogram")
+            lines += histogram.render()
+        with self._lock:
+            sessions = list(self._sessions)
+        lines += header("camera_clients", "Connected stream clients", "gauge")
+        lines.append("camera_clients {}".format(len(sessions)))
+        lines += header(
+            "camera_client_bytes_sent", "Bytes sent to a stream client", "counter"
+        )
+        for session in sessions:
+            lines.append(
+                'camera_client_bytes_sent{{client="{}"}} {}'.format(
+                    session.client, session.bytes_sent
+                )
+            )
+        lines += header(
+            "camera_client_frames_dropped",
+            "Frames skipped while a stream client was busy",
+            "counter",
+        )
+        for session in sessions:
+            lines.append(
+                'camera_client_frames_dropped{{client="{}"}} {}'.format(
+                    session.client, session.frames_dropped
+                )
+            )
+        lines += header(
+            "camera_client_write_seconds",
+            "Time spent writing a frame to a stream client",
+            "histogram",
+        )
+        for session in sessions:
+            lines += session.write_latency.render('client="{}"'.format(session.client))
+        return ("\n".join(lines) + "\n").encode()
+
+
+metrics = PipelineMetrics()
@@ -0,0 +1,196 @@
+import cv2
+import json
+import os
+import threading
+import time
+
+from . import overlay_lib
+from .log import logger
+
+# How often render() looks at the layout file's modification time
+RELOAD_CHECK_IN_SEC = 1.0
+
+# Where each telemetry value goes. "text" is formatted with the telemetry
+# dict, x is ["left" | "right", columns] and y is ["top" | "bottom", rows]:
+# columns are multiples of font_space from left_col (or right_col * width),
+# rows are multiples of row_height from the padding at the top or bottom.
+DEFAULT_ELEMENTS = [
+    {"field": "imu_roll", "text": "{euler[0]}", "x": ["left", 0], "y": ["top", 0]},
+    {"field": "imu_pitch", "text": "{euler[1]}", "x": ["left", 3], "y": ["top", 0]},
+    {"field": "imu_yaw", "text": "{euler[2]}", "x": ["left", 6], "y": ["top", 0]},
+    {"field": "temp", "text": "{temp} C", "x": ["left", 0], "y": ["top", 1]},
+    {"field": "alt", "text": "{alt} m", "x": ["left", 3], "y": ["top", 1]},
+    {"field": "joy_x", "text": "{x}", "x": ["left", 0], "y": ["bottom", 0]},
+    {"field": "joy_y", "text": "{y}", "x": ["left", 2], "y": ["bottom", 0]},
+    {"field": "power", "text": "{power}", "x": ["right", 0], "y": ["bottom", 0]},
+    {"field": "CPU", "text": "{CPU}", "x": ["right", 0], "y": ["bottom", 1]},
+    {"field": "FPS", "text": "FPS: {fps}", "x": ["right", 0], "y": ["bottom", 2]},
+]
+# Text that never changes, drawn once into the static layer with the
+# crosshair. x and y are in pixels.
+DEFAULT_LABELS = [{"text": "d: 0", "x": 100, "y": 100}]
+# Telemetry with the keys the camera node passes to render(), a layout file
+# is tried with it before it replaces the running one
+PLACEHOLDER_TELEMETRY = {
+    "x": 0,
+    "y": 0,
+    "power": "N/A",
+    "CPU": "N/A",
+    "fps": 0,
+    "euler": [0.0, 0.0, 0.0],
+    "temp": "N/A",
+    "alt": "N/A",
+}
+CHECK_SIZE = (640, 480)
+
+
+def default_layout():
+    layout = dict(overlay_lib.overlay_settings)
+    layout["crosshair"] = True
+    layout["labels"] = DEFAULT_LABELS
+    layout["elements"] = DEFAULT_ELEMENTS
+    return layout
+
+
+class OverlayLayout(object):
+    """Overlay settings compiled to pixels for one resolution.
+
+    Everything that used to be derived from overlay_settings on every draw_*
+    call (font scale, row height, column positions) is resolved once here.
+    render(frame, telemetry) applies the static layer and draws every
+    telemetry element.
+    """
+
+    def __init__(self, settings, width, height):
+        self.width = width
+        self.height = height
+        self.font = settings["font"]
+        self.font_size = settings["font_size"] * width / 320
+        self.font_color = tuple(settings["font_color"])
+        self.font_thickness = int(settings["font_thickness"])
+        padding = settings["padding"]
+        row_height = settings["row_height"] * width / 320
+        font_space = settings["font_space"]
+        left = settings["left_col"]
+        right = settings["right_col"] * width
+
+        def resolve_x(x):
+            anchor, columns = x
+            return int((left if anchor == "left" else right) + columns * font_space)
+
+        def resolve_y(y):
+            anchor, rows = y
+            if anchor == "top":
+                return int(padding + rows * row_height)
+            return int(height - padding - rows * row_height)
+
+        self.elements = [
+            (e["field"], e["text"], (resolve_x(e["x"]), resolve_y(e["y"])))
+            for e in settings.get("elements", DEFAULT_ELEMENTS)
+        ]
+        crosshair = settings.get("crosshair", True)
+        labels = settings.get("labels", DEFAULT_LABELS)
+
+        def draw_static(canvas):
+            for label in labels:
+                cv2.putText(
+                    canvas,
+                    str(label["text"]),
+                    (int(label["x"]), int(label["y"])),
+                    self.font,
+                    self.font_size,
+                    self.font_color,
+                    self.font_thickness,
+                    cv2.LINE_AA,
+                )
+            if crosshair:
+                overlay_lib.drawCrosshair(canvas, width, height)
+
+        self.static_layer = overlay_lib.OverlayLayer(width, height, draw_static)
+
+    def render(self, frame, telemetry):
+        self.static_layer.apply(frame)
+        for field, text, org in self.elements:
+            overlay_lib.put_text(
+                frame,
+                field,
+                text.format(**telemetry),
+                org,
+                self.font,
+                self.font_size,
+                self.font_color,
+                self.font_thickness,
+            )
+
+
+class LayoutManager(object):
+    """Compiles one OverlayLayout per resolution and reloads them on change.
+
+    The layout comes from the built-in settings or from a JSON file with the
+    same keys as overlay_lib.overlay_settings plus "crosshair", "labels" and
+    "elements". Editing the file is picked up while the camera node runs.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._mtime = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._settings = default_layout()
+        self._layouts = {}
+        if path is not None:
+            self.reload()
+
+    def reload(self):
+        settings = default_layout()
+        if self.path is not None:
+            try:
+                self._mtime = os.path.getmtime(self.path)
+                with open(self.path, "r") as f:
+                    settings.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.info("cannot load layout {}: {}".format(self.path, e))
+                return False
+            # Valid JSON is not enough, a bad element would otherwise raise
+            # on every frame. The previous layout stays in use.
+            try:
+                check = OverlayLayout(settings, *CHECK_SIZE)
+                for _, text, _ in check.elements:
+                    text.format(**PLACEHOLDER_TELEMETRY)
+            except Exception as e:
+                logger.info(
+                    "layout {} does not fit the overlay: {!r}".format(self.path, e)
+                )
+                return False
+        with self._lock:
+            self._settings = settings
+            self._layouts = {}
+        logger.info("overlay layout loaded from {}".format(self.path or "defaults"))
+        return True
+
+    def _check_reload(self):
+        now = time.time()
+        if self.path is None or now - self._last_check < RELOAD_CHECK_IN_SEC:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def layout(self, width, height):
+        self._check_reload()
+        layout = self._layouts.get((width, height))
+        if layout is None:
+            with self._lock:
+                layout = self._layouts.get((width, height))
+                if layout is None:
+                    layout = OverlayLayout(self._settings, width, height)
+                    self._layouts[(width, height)] = layout
+        return layout
+
+    def render(self, frame, telemetry):
+        height, width = frame.shape[:2]
+        self.layout(width, height).render(frame, telemetry)
@@ -1,5 +1,12 @@
 import cv2
 import json
+import threading
+
+import numpy as np
+
+# Characters pre-rasterized in the glyph atlas, enough for the numeric
+# telemetry fields. Strings with other characters are rendered whole.
+ATLAS_CHARSET = "0123456789.,-+:%*/ CFPSUVm"
 
 o_settings = '{ "thickness":0, "font":0, "font_size":0.2, "font_space":25, "font_color": [255, 255, 0], "right_col":0.9, "left_col":0.1, "font_thickness": 1,"row_height": 10, "column":15, "padding": 30}'
 overlay_settings = json.loads(o_settings)
@@ -46,57 +53,57 @@ def draw_IMU(frame, imu, temp, alt, width, height):
     column = overlay_settings["column"] * w / 320
     font_space = overlay_settings["font_space"]
 
-    cv2.putText(
+    put_text(
         frame,
+        "imu_roll",
         str(imu[0]),
         (int(left_col), int(padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
-    cv2.putText(
+    put_text(
         frame,
+        "imu_pitch",
         str(imu[1]),
         (int(left_col + 3 * font_space), int(padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
-    cv2.putText(
+    put_text(
         frame,
+        "imu_yaw",
         str(imu[2]),
         (int(left_col + 6 * font_space), int(padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
     temp = str(temp) + " C"
-    cv2.putText(
+    put_text(
         frame,
+        "temp",
         str(temp),
         (int(left_col), int(padding + row_height)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
     alt = str(alt) + " m"
-    cv2.putText(
+    put_text(
         frame,
+        "alt",
         str(alt),
         (int(left_col + 3 * font_space), int(padding + row_height)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
 
 
@@ -159,25 +166,25 @@ def draw_joy(frame, x, y, width, height):
     column = overlay_settings["column"] * w / 320
     font_space = overlay_settings["font_space"]
 
-    cv2.putText(
+    put_text(
         frame,
+        "joy_x",
         str(x),
         (int(left_col), int(h - padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
-    cv2.putText(
+    put_text(
         frame,
+        "joy_y",
         str(y),
         (int(left_col + 2 * font_space), int(h - padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
 
 
@@ -194,15 +201,15 @@ def drawOverlay(ret, frame, f, width, height):
     padding = overlay_settings["padding"]
     row_height = overlay_settings["row_height"] * w / 320
     column = overlay_settings["column"] * w / 320
-    cv2.putText(
+    put_text(
         frame,
+        "fps_counter",
         str(int(f)),
         (w - 20, h - 20),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
 
 
@@ -220,15 +227,15 @@ def draw_power(frame, pow, width, height):
     row_height = overlay_settings["row_height"] * w / 320
     column = overlay_settings["column"] * w / 320
 
-    cv2.putText(
+    put_text(
         frame,
+        "power",
         str(pow),
         (int(right_col * w), int(h - padding)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
 
 
@@ -246,15 +253,15 @@ def draw_CPU(frame, CPU, width, height):
     row_height = overlay_settings["row_height"] * w / 320
     column = overlay_settings["column"] * w / 320
 
-    cv2.putText(
+    put_text(
         frame,
+        "CPU",
         str(CPU),
         (int(right_col * w), int(h - padding - row_height)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
 
 
@@ -272,13 +279,274 @@ def draw_FPS(frame, FPS, width, height):
     row_height = overlay_settings["row_height"] * w / 320
     column = overlay_settings["column"] * w / 320
 
-    cv2.putText(
+    put_text(
         frame,
+        "FPS",
         str(FPS),
         (int(right_col * w), int(h - padding - 2 * row_height)),
         font,
         font_size,
         font_color,
         font_thickness,
-        cv2.LINE_AA,
     )
+
+
+class OverlayLayer(object):
+    """Overlay content rendered once and blended into frames.
+
+    draw(canvas) is run twice, on a black and on a white canvas. The two
+    results give the colour and the coverage of every pixel, including the
+    anti-aliased edges of text. The covered areas are split into bounding
+    boxes. A box of opaque strokes only, like the crosshair, is copied
+    through its precomputed mask, the others are blended with two cv2
+    arithmetic calls. Pixels outside the boxes are never touched.
+    """
+
+    # Gap in pixels under which nearby strokes share one bounding box
+    MERGE_DISTANCE = 24
+
+    def __init__(self, width, height, draw):
+        black = np.zeros((height, width, 3), np.uint8)
+        white = np.full((height, width, 3), 255, np.uint8)
+        draw(black)
+        draw(white)
+        # On black: b = a * c, on white: w = a * c + (1 - a) * 255
+        keep = (white.astype(np.int16) - black).max(axis=2).astype(np.uint8)
+        self.shape = (height, width)
+        covered = (keep < 255).astype(np.uint8)
+        kernel = np.ones((self.MERGE_DISTANCE, self.MERGE_DISTANCE), np.uint8)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(
+            cv2.dilate(covered, kernel)
+        )
+        self._opaque = []
+        self._blended = []
+        for x, y, w, h, _ in stats[1:count]:
+            box = (slice(y, y + h), slice(x, x + w))
+            box_keep = keep[box]
+            colour = black[box].copy()
+            if np.isin(box_keep, (0, 255)).all():
+                mask = (box_keep == 0).astype(np.uint8)
+                self._opaque.append((box, mask, colour))
+            else:
+                self._blended.append((box, cv2.merge([box_keep] * 3), colour))
+
+    def apply(self, frame):
+        for box, mask, colour in self._opaque:
+            cv2.copyTo(colour, mask, frame[box])
+        for box, keep, colour in self._blended:
+            roi = frame[box]
+            # frame * (1 - alpha) + colour * alpha
+            cv2.add(cv2.multiply(roi, keep, scale=1 / 255.0), colour, dst=roi)
+
+
+class OverlayCompositor(object):
+    """Caches one OverlayLayer per (width, height, mode).
+
+    draw_static(canvas, width, height, mode) draws the parts of the overlay
+    that only depend on the resolution and the display config (crosshair,
+    labels). They are rendered the first time a combination is seen and then
+    applied to every frame in a single pass.
+    """
+
+    def __init__(self, draw_static):
+        self._draw_static = draw_static
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def layer(self, width, height, mode):
+        key = (width, height, mode)
+        layer = self._layers.get(key)
+        if layer is None:
+            with self._lock:
+                layer = self._layers.get(key)
+                if layer is None:
+                    layer = OverlayLayer(
+                        width,
+                        height,
+                        lambda canvas: self._draw_static(canvas, width, height, mode),
+                    )
+                    self._layers[key] = layer
+        return layer
+
+    def apply(self, frame, mode):
+        height, width = frame.shape[:2]
+        self.layer(width, height, mode).apply(frame)
+
+    def clear(self):
+        with self._lock:
+            self._layers = {}
+
+
+class TextSprite(object):
+    """Coverage bitmap of a rendered string.
+
+    (dx, dy) is the offset of the bitmap's top-left corner from the text
+    origin used by cv2.putText (bottom-left corner of the text). blend()
+    gives the same pixels as cv2.putText with cv2.LINE_AA, with two cv2
+    arithmetic calls on the text's bounding box instead of a rasterization.
+    """
+
+    def __init__(self, alpha, dx, dy):
+        self.alpha = alpha
+        self.dx = dx
+        self.dy = dy
+        self._keep = cv2.merge([255 - alpha] * 3)
+        self._colour = None
+
+    @classmethod
+    def render(cls, text, font, font_size, font_thickness, height=None):
+        (width, text_height), baseline = cv2.getTextSize(
+            text, font, font_size, font_thickness
+        )
+        if height is None:
+            height = text_height
+        pad = font_thickness + 1
+        canvas = np.zeros((height + baseline + 2 * pad, width + 2 * pad), np.uint8)
+        cv2.putText(
+            canvas,
+            text,
+            (pad, pad + height),
+            font,
+            font_size,
+            255,
+            font_thickness,
+            cv2.LINE_AA,
+        )
+        return cls(canvas, -pad, -(pad + height))
+
+    def _premultiplied(self, colour):
+        if self._colour is None or self._colour[0] != colour:
+            h, w = self.alpha.shape
+            solid = np.empty((h, w, 3), np.uint8)
+            solid[:] = colour
+            alpha = cv2.merge([self.alpha] * 3)
+            self._colour = (colour, cv2.multiply(solid, alpha, scale=1 / 255.0))
+        return self._colour[1]
+
+    def blend(self, frame, org, colour):
+        h, w = self.alpha.shape
+        x0 = int(org[0]) + self.dx
+        y0 = int(org[1]) + self.dy
+        colour = self._premultiplied(tuple(colour))
+        keep = self._keep
+        if x0 < 0 or y0 < 0 or x0 + w > frame.shape[1] or y0 + h > frame.shape[0]:
+            # Clip to the frame, text partly outside is cut like putText does
+            fx0, fy0 = max(x0, 0), max(y0, 0)
+            fx1, fy1 = min(x0 + w, frame.shape[1]), min(y0 + h, frame.shape[0])
+            if fx0 >= fx1 or fy0 >= fy1:
+                return
+            sy = slice(fy0 - y0, fy1 - y0)
+            sx = slice(fx0 - x0, fx1 - x0)
+            colour, keep = colour[sy, sx], keep[sy, sx]
+            x0, y0, w, h = fx0, fy0, fx1 - fx0, fy1 - fy0
+        roi = frame[y0 : y0 + h, x0 : x0 + w]
+        # frame * (1 - alpha) + colour * alpha
+        cv2.add(cv2.multiply(roi, keep, scale=1 / 255.0), colour, dst=roi)
+
+
+class GlyphAtlas(object):
+    """Pre-rasterized glyphs of one font style.
+
+    Strings made only of atlas characters are built by placing the glyph
+    bitmaps side by side, without calling cv2.putText.
+    """
+
+    def __init__(self, font, font_size, font_thickness, charset=ATLAS_CHARSET):
+        self.charset = set(charset)
+        height = max(
+            cv2.getTextSize(c, font, font_size, font_thickness)[0][1] for c in charset
+        )
+        self._glyphs = {}
+        for c in charset:
+            sprite = TextSprite.render(c, font, font_size, font_thickness, height)
+            # Hershey advances are fractional, measure them on a long run
+            run = cv2.getTextSize(c * 10, font, font_size, font_thickness)[0][0]
+            self._glyphs[c] = (sprite, (run - font_thickness) / 10.0)
+
+    def covers(self, text):
+        return all(c in self.charset for c in text)
+
+    def compose(self, text):
+        # Every glyph shares the same top offset, so they line up at y = 0
+        glyphs = []
+        x = 0.0
+        for c in text:
+            sprite, advance = self._glyphs[c]
+            glyphs.append((sprite.alpha, int(round(x))))
+            x += advance
+        height = max(alpha.shape[0] for alpha, _ in glyphs)
+        width = max(px + alpha.shape[1] for alpha, px in glyphs)
+        canvas = np.zeros((height, width), np.uint8)
+        for alpha, px in glyphs:
+            gh, gw = alpha.shape
+            roi = canvas[:gh, px : px + gw]
+            np.maximum(roi, alpha, out=roi)
+        first = self._glyphs[text[0]][0]
+        return TextSprite(canvas, first.dx, first.dy)
+
+
+class TextCache(object):
+    """Keeps the last rendered bitmap of every overlay text field.
+
+    A field is re-rasterized only when its string changes, numeric strings
+    are composed from the GlyphAtlas of the field's font style.
+    """
+
+    def __init__(self, charset=ATLAS_CHARSET):
+        self._charset = charset
+        self._atlases = {}
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def atlas(self, style):
+        atlas = self._atlases.get(style)
+        if atlas is None:
+            with self._lock:
+                atlas = self._atlases.get(style)
+                if atlas is None:
+                    atlas = GlyphAtlas(*style, charset=self._charset)
+                    self._atlases[style] = atlas
+        return atlas
+
+    def sprite(self, field, text, font, font_size, font_thickness):
+        # Keyed by style too, so streams at different scales do not keep
+        # invalidating each other's bitmaps
+        style = (font, font_size, font_thickness)
+        cached = self._fields.get((field, style))
+        if cached is not None and cached[0] == text:
+            return cached[1]
+        atlas = self.atlas(style)
+        if text and atlas.covers(text):
+            sprite = atlas.compose(text)
+        else:
+            sprite = TextSprite.render(text, *style)
+        # Replaced as a whole so concurrent readers see a consistent entry
+        self._fields[(field, style)] = (text, sprite)
+        return sprite
+
+
+text_cache = TextCache()
+# Off by default: at the overlay's font sizes cv2.putText is cheaper than the
+# blend, on an x86 desktop the whole overlay takes about 210 us with the cache
+# and 110 us without at 640x480. Run benchmark/bench_overlay.py on the target
+# before turning it on.
+use_text_cache = False
+
+
+def put_text(frame, field, text, org, font, font_size, font_color, font_thickness):
+    # Same result as cv2.putText(..., cv2.LINE_AA), for a named overlay field
+    text = str(text)
+    if not use_text_cache:
+        cv2.putText(
+            frame,
+            text,
+            (int(org[0]), int(org[1])),
+            font,
+            font_size,
+            font_color,
+            font_thickness,
+            cv2.LINE_AA,
+        )
+        return
+    sprite = text_cache.sprite(field, text, font, font_size, font_thickness)
+    sprite.blend(frame, org, font_color)
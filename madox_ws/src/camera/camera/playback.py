@@ -0,0 +1,145 @@
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from .log import logger
+from .recorder import RECORD_DIR, SegmentReader, list_segments, list_sessions
+
+URL_PATH_PLAYBACK = "/playback.mjpg"
+# Frames sent per second at most, faster playback skips recorded frames
+PLAYBACK_FPS = 30.0
+MAX_SPEED = 64.0
+# Timestamps are not exact multiples of the frame period
+TOLERANCE_IN_SEC = 0.002
+
+
+class PlaybackError(ValueError):
+    pass
+
+
+def parse_playback_query(path, directory=RECORD_DIR):
+    # /playback.mjpg?session=<name>&t=<seconds from the start>&speed=<x>
+    query = parse_qs(urlsplit(path).query)
+    sessions = list_sessions(directory)
+    session = query.get("session", [sessions[-1] if sessions else ""])[0]
+    if session not in sessions:
+        raise PlaybackError("unknown session {!r}".format(session))
+    try:
+        t = max(0.0, float(query.get("t", ["0"])[0]))
+        speed = float(query.get("speed", ["1"])[0])
+    except ValueError:
+        raise PlaybackError("t and speed must be numbers")
+    if not 0 < speed <= MAX_SPEED:
+        raise PlaybackError("speed must be in (0, {}]".format(MAX_SPEED))
+    return "{}/{}".format(directory, session), t, speed
+
+
+class PlaybackCursor(object):
+    """Walks the frames of a recorded session in real time times speed.
+
+    Seeking bisects the segment indexes and frames are memoryviews of the
+    mapped segments, so nothing is decoded or re-encoded. At high speed the
+    cursor jumps straight to the frame due next instead of reading the ones
+    in between, the output never goes over max_fps.
+
+    next() returns (delay, timestamp, jpeg) where delay is how long the
+    caller should wait before sending the frame, or None at the end of the
+    recording.
+    """
+
+    def __init__(self, session_dir, t=0.0, speed=1.0, max_fps=PLAYBACK_FPS):
+        self.session_dir = session_dir
+        self.speed = speed
+        # Recording time between two frames sent
+        self.step = speed / max_fps
+        self.segments = list_segments(session_dir)
+        self._path = None
+        self._reader = None
+        self._position = 0
+        self._start = None
+        self._clock = None
+        self._target = self._seek(t)
+
+    def _load(self, path):
+        # The recorder's quota may delete a segment at any time, even the
+        # one just listed. It is then skipped.
+        try:
+            return SegmentReader(path)
+        except OSError as e:
+            logger.info("playback skips {}: {}".format(path, e))
+            return None
+
+    def _seek(self, t):
+        # Absolute timestamp of the first frame to send, the reader is left
+        # on the segment that contains it
+        first = None
+        for i, path in enumerate(self.segments):
+            reader = self._load(path)
+            if reader is None:
+                continue
+            if not len(reader):
+                reader.close()
+                continue
+            if first is None:
+                first = reader.start
+            if reader.end >= first + t or i == len(self.segments) - 1:
+                self._open(path, reader)
+                return first + t
+            reader.close()
+        return None
+
+    def _open(self, path, reader):
+        if self._reader is not None:
+            self._reader.close()
+        self._path = path
+        self._reader = reader
+        self._position = 0
+
+    def _advance_segment(self):
+        # Moves to the next segment with frames. The session may still be
+        # recording, so the list and the last segment are looked at again.
+        # Segments are found by name, not position: the quota removes the
+        # oldest ones from the front of the list.
+        self.segments = list_segments(self.session_dir)
+        for path in self.segments:
+            if path <= self._path:
+                continue
+            reader = self._load(path)
+            if reader is None:
+                continue
+            self._open(path, reader)
+            if len(reader):
+                return True
+        count = len(self._reader)
+        reader = self._load(self._path)
+        if reader is None:
+            return False
+        if len(reader) > count:
+            self._open(self._path, reader)
+            self._position = count
+            return True
+        reader.close()
+        return False
+
+    def next(self):
+        if self._target is None or self._reader is None:
+            return None
+        while True:
+            i = self._reader.find(self._target - TOLERANCE_IN_SEC)
+            i = max(self._position, i)
+            if i < len(self._reader):
+                break
+            if not self._advance_segment():
+                return None
+        timestamp, seq, jpeg = self._reader.frame(i)
+        self._position = i + 1
+        self._target = max(timestamp, self._target) + self.step
+        now = time.time()
+        if self._start is None:
+            self._start, self._clock = timestamp, now
+        delay = (timestamp - self._start) / self.speed - (now - self._clock)
+        return max(0.0, delay), timestamp, jpeg
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
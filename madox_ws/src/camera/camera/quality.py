@@ -0,0 +1,80 @@
+import time
+
+# Share of the wall time a client may spend blocked in write() before the
+# stream is stepped down to a cheaper tier
+CONGESTED_UTILIZATION = 0.7
+# Below this share the link has headroom and the stream may step back up
+RELAXED_UTILIZATION = 0.3
+# Consecutive relaxed windows required before stepping up, so a link that
+# just recovered is not pushed straight back into congestion
+UPGRADE_WINDOWS = 3
+WINDOW_IN_SEC = 1.0
+
+
+def quality_tiers(min_quality, max_quality, step, min_scale=1.0, scale_step=0.25):
+    # Ordered from best to cheapest: first the JPEG quality is lowered at full
+    # resolution, then, if min_scale allows it, the resolution is reduced at
+    # the lowest quality. Clients on the same tier share the same encode.
+    min_quality = max(1, min(min_quality, max_quality))
+    step = max(1, step)
+    tiers = [(q, 1.0) for q in range(max_quality, min_quality, -step)]
+    tiers.append((min_quality, 1.0))
+    scale = 1.0 - scale_step
+    while scale >= min_scale - 1e-6 and scale > 0:
+        tiers.append((min_quality, round(scale, 2)))
+        scale -= scale_step
+    return tiers
+
+
+class QualityController(object):
+    """Picks the JPEG quality and scale of one stream client.
+
+    Every WINDOW_IN_SEC the controller looks at how much of the time the
+    client spent writing frames and how many bytes per second got through,
+    then moves one tier down when the link is saturated or one tier up after
+    a few windows with spare capacity.
+    """
+
+    def __init__(self, tiers, window=WINDOW_IN_SEC):
+        self.tiers = tiers
+        self.index = 0
+        self.window = window
+        self.bytes_per_sec = 0.0
+        self.utilization = 0.0
+        self._relaxed_windows = 0
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self._window_start = now
+        self._busy = 0.0
+        self._bytes = 0
+
+    @property
+    def quality(self):
+        return self.tiers[self.index][0]
+
+    @property
+    def scale(self):
+        return self.tiers[self.index][1]
+
+    def update(self, nbytes, send_time):
+        self._busy += send_time
+        self._bytes += nbytes
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        self.utilization = self._busy / elapsed
+        self.bytes_per_sec = self._bytes / elapsed
+        if self.utilization > CONGESTED_UTILIZATION:
+            self._relaxed_windows = 0
+            if self.index < len(self.tiers) - 1:
+                self.index += 1
+        elif self.utilization < RELAXED_UTILIZATION:
+            self._relaxed_windows += 1
+            if self._relaxed_windows >= UPGRADE_WINDOWS and self.index > 0:
+                self.index -= 1
+                self._relaxed_windows = 0
+        else:
+            self._relaxed_windows = 0
+        self._reset(now)
@@ -0,0 +1,318 @@
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from .framing import part_header
+from .log import logger
+
+RECORD_DIR = "recordings"
+SEGMENT_SECONDS = 60.0
+SEGMENT_BYTES = 256 * 1024 * 1024
+QUOTA_BYTES = 4 * 1024 * 1024 * 1024
+QUEUE_SIZE = 64
+# After a write error (disk full, drive removed) frames are dropped for this
+# long before the next segment is tried, doubling up to the maximum
+RETRY_IN_SEC = 1.0
+MAX_RETRY_IN_SEC = 30.0
+SEGMENT_SUFFIX = ".mjpg"
+INDEX_SUFFIX = ".idx"
+# One index record per frame: offset and size of the JPEG bytes in the
+# segment, capture timestamp and frame sequence number
+INDEX_RECORD = struct.Struct("<QIdQ")
+
+
+class SegmentRecorder(threading.Thread):
+    """Writes the encoded stream to rotating, indexed MJPEG segments.
+
+    push() is a sink of the EncodePump and only queues a reference to the
+    EncodedFrame, the bytes were already encoded for the live stream. The
+    thread appends every frame as a multipart part to <session>/<n>.mjpg,
+    so a segment plays as is, and a fixed size record to <n>.idx with the
+    offset, size, timestamp and seq of the JPEG bytes. Segments rotate
+    after segment_seconds or segment_bytes, the oldest ones of any session
+    are deleted to stay under the quota. A write error closes the segment,
+    it keeps the frames indexed so far, and recording starts again in a new
+    segment after a back-off.
+    """
+
+    def __init__(
+        self,
+        directory=RECORD_DIR,
+        segment_seconds=SEGMENT_SECONDS,
+        segment_bytes=SEGMENT_BYTES,
+        quota_bytes=QUOTA_BYTES,
+        queue_size=QUEUE_SIZE,
+    ):
+        super().__init__(name="segment-recorder", daemon=True)
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.quota_bytes = quota_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = time.strftime("%Y%m%d-%H%M%S")
+        self.dropped = 0
+        self._data = None
+        self._index = None
+        self._segment = 0
+        self._segment_start = 0.0
+        self._offset = 0
+        # (data path, index path, size), oldest first
+        self._segments = []
+        self._total = 0
+
+    @property
+    def session_dir(self):
+        return os.path.join(self.directory, self.session)
+
+    def push(self, encoded):
+        try:
+            self.queue.put_nowait(encoded)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        self._scan()
+        logger.info("recording to {}".format(self.session_dir))
+        backoff = RETRY_IN_SEC
+        retry_at = 0.0
+        try:
+            while True:
+                item = self.queue.get()
+                batch = [item]
+                while item is not None:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                stop = batch[-1] is None
+                frames = [entry for entry in batch if entry is not None]
+                if time.monotonic() < retry_at:
+                    self.dropped += len(frames)
+                else:
+                    try:
+                        self._write_batch(frames)
+                        backoff = RETRY_IN_SEC
+                    except OSError as e:
+                        logger.warning(
+                            "recording failed, retrying in {:.0f} s: {}".format(
+                                backoff, e
+                            )
+                        )
+                        self.dropped += len(frames)
+                        self._abort_segment()
+                        retry_at = time.monotonic() + backoff
+                        backoff = min(backoff * 2, MAX_RETRY_IN_SEC)
+                if stop:
+                    return
+        finally:
+            try:
+                self._close_segment()
+            except OSError as e:
+                logger.warning("cannot close the last segment: {}".format(e))
+                self._abort_segment()
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(SEGMENT_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                index = path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+                try:
+                    st = os.stat(path)
+                    size = st.st_size + os.path.getsize(index)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, index, size))
+        for _, path, index, size in sorted(files):
+            self._segments.append((path, index, size))
+            self._total += size
+
+    def _write_batch(self, batch):
+        records = []
+        for encoded in batch:
+            if self._data is None or self._should_rotate(encoded):
+                if records:
+                    self._index.write(b"".join(records))
+                    records = []
+                self._close_segment()
+                self._open_segment(encoded.timestamp)
+            header = part_header(encoded.nbytes, encoded.timestamp)
+            self._data.write(header)
+            self._data.write(encoded.data)
+            self._data.write(b"\r\n")
+            records.append(
+                INDEX_RECORD.pack(
+                    self._offset + len(header),
+                    encoded.nbytes,
+                    encoded.timestamp,
+                    encoded.seq,
+                )
+            )
+            self._offset += len(header) + encoded.nbytes + 2
+        if records:
+            # The index is flushed after the data, a reader never sees an
+            # index record pointing past the end of the segment
+            self._data.flush()
+            self._index.write(b"".join(records))
+            self._index.flush()
+
+    def _should_rotate(self, encoded):
+        return (
+            encoded.timestamp - self._segment_start >= self.segment_seconds
+            or self._offset >= self.segment_bytes
+        )
+
+    def _open_segment(self, timestamp):
+        # Created here rather than once, a drive plugged back in gets it again
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._segment += 1
+        base = os.path.join(self.session_dir, "{:06d}".format(self._segment))
+        data = open(base + SEGMENT_SUFFIX, "wb")
+        try:
+            index = open(base + INDEX_SUFFIX, "wb")
+        except OSError:
+            data.close()
+            raise
+        self._data, self._index = data, index
+        self._segment_start = timestamp
+        self._offset = 0
+
+    def _close_segment(self):
+        if self._data is None:
+            return
+        size = 0
+        for f in (self._data, self._index):
+            f.flush()
+            os.fsync(f.fileno())
+            size += f.tell()
+            f.close()
+        self._segments.append((self._data.name, self._index.name, size))
+        self._total += size
+        self._data = self._index = None
+        self._enforce_quota()
+
+    def _abort_segment(self):
+        # After a write error: the files are closed as they are, the index
+        # never points past the data so the segment still plays
+        if self._data is None:
+            return
+        size = 0
+        for f in (self._data, self._index):
+            try:
+                f.close()
+            except OSError:
+                pass
+            try:
+                size += os.path.getsize(f.name)
+            except OSError:
+                pass
+        self._segments.append((self._data.name, self._index.name, size))
+        self._total += size
+        self._data = self._index = None
+        self._enforce_quota()
+
+    def _enforce_quota(self):
+        while self._total > self.quota_bytes and self._segments:
+            data, index, size = self._segments.pop(0)
+            self._total -= size
+            for path in (data, index):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class SegmentReader(object):
+    """Random access to the frames of one recorded segment.
+
+    The index is loaded with a single read and the segment is memory
+    mapped: frame(i) is a memoryview of the JPEG bytes, nothing is copied
+    or decoded until it is used. A segment that is
+    still being written can be opened, it shows the frames indexed so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index_path = path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        with open(index_path, "rb") as f:
+            index = f.read()
+        count = len(index) // INDEX_RECORD.size
+        self.records = [
+            INDEX_RECORD.unpack_from(index, i * INDEX_RECORD.size) for i in range(count)
+        ]
+        self.timestamps = [record[2] for record in self.records]
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:
+            # An empty file cannot be mapped
+            self._map = None
+            self._view = memoryview(b"")
+        # Drop records whose bytes were not in the file when it was mapped
+        while self.records and sum(self.records[-1][:2]) > size:
+            self.records.pop()
+            self.timestamps.pop()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def start(self):
+        return self.timestamps[0] if self.timestamps else None
+
+    @property
+    def end(self):
+        return self.timestamps[-1] if self.timestamps else None
+
+    def find(self, timestamp):
+        # Index of the first frame captured at or after timestamp
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def frame(self, i):
+        # (timestamp, seq, JPEG bytes as a memoryview of the segment)
+        offset, size, timestamp, seq = self.records[i]
+        return timestamp, seq, self._view[offset : offset + size]
+
+    def close(self):
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A frame is still in use, the map goes away with it
+                pass
+        self._file.close()
+
+
+def list_sessions(directory=RECORD_DIR):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(n for n in names if os.path.isdir(os.path.join(directory, n)))
+
+
+def list_segments(session_dir):
+    try:
+        names = os.listdir(session_dir)
+    except OSError:
+        return []
+    return [
+        os.path.join(session_dir, n)
+        for n in sorted(names)
+        if n.endswith(SEGMENT_SUFFIX)
+    ]
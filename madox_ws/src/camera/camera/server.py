@@ -1,8 +1,8 @@
 import rclpy
 from rclpy.node import Node
+from rclpy.utilities import remove_ros_args
 import threading
 from threading import Lock
-import uuid
 
 import camera.overlay_lib as overlay_lib
 
@@ -11,23 +11,70 @@ import camera.overlay_lib as overlay_lib
 from std_msgs.msg import String
 from std_msgs.msg import Int32MultiArray, Int16
 from sensor_msgs.msg import Joy, Imu, FluidPressure, Temperature
+from std_srvs.srv import Trigger
 
 
 import argparse
 import cv2
+import socket
+import sys
 import time
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
-from .camera import Camera
+from .async_server import AsyncStreamServer
+from .camera import FRAME_TIMEOUT_IN_SEC, Camera
+from .change_detect import ChangeDetector
+from .clip_buffer import ClipBuffer
+from .encode_pool import EncodePool
+from .encoder import PLAIN_MODE, EncodeCache, EncodePump
+from .framing import MULTIPART_TYPE, URL_PATH_MJPG, part_header, send_parts
+from .gst_pipeline import DEFAULT_SETTINGS as PIPELINE_SETTINGS
+from .image_publisher import (
+    DEFAULT_SETTINGS as IMAGE_SETTINGS,
+    CompressedImagePublisher,
+)
+from .quality import quality_tiers
+from .recorder import SegmentRecorder
 from .log import logger
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, URL_PATH_METRICS, metrics
+from .overlay_layout import LayoutManager
+from .playback import (
+    URL_PATH_PLAYBACK,
+    PlaybackCursor,
+    PlaybackError,
+    parse_playback_query,
+)
 
 from .debounce import ButtonHandler
-
-URL_PATH_MJPG = "/camera.mjpg"
-URL_PATH_FAVICON = "/favicon.ico"
-SLEEP_IN_SEC = 0.050
+from .shm_bus import BUS_NAME, FrameBusWriter
+from .snapshot_writer import SnapshotWriter
+from .still import URL_PATH_SNAPSHOT, etag, still_frame, still_key
+from .static_files import URL_PATH_FAVICON, load_index
+from .stream_session import (
+    RETRY_AFTER_IN_SEC,
+    ClientLimit,
+    StreamSession,
+    configure_stream_socket,
+    default_key,
+)
+from .variants import VariantError, parse_variant
+from .websocket import (
+    ACK_TIMEOUT_IN_SEC,
+    URL_PATH_WS,
+    AckReader,
+    AckWindow,
+    WebSocketError,
+    handshake,
+    video_head,
+)
+
+# Joystick buttons
+DISPLAY_BUTTON = 9
+CLIP_BUTTON = 4
+# Display config that hides the video
+HIDDEN_CONFIG = 2
 
 x = 0
 y = 0
@@ -37,17 +84,78 @@ CPU_info = "N/A"
 euler = [0.0, 0.0, 0.0]
 temp = "N/A"
 alt = "N/A"
-diff_fps = 1
 flash_message = ""
 take_snapshot = False
+clip_buffer = None
+
+
+def draw_static_overlay(frame, width, height, mode):
+    # Display config 1 only shows the crosshair, rendered once by the
+    # compositor
+    if mode == 1:
+        overlay_lib.drawCrosshair(frame, width, height)
+
+
+compositor = overlay_lib.OverlayCompositor(draw_static_overlay)
+layouts = LayoutManager()
+
+
+def telemetry():
+    return {
+        "x": x,
+        "y": y,
+        "power": power_info,
+        "CPU": CPU_info,
+        # Rate of the capture thread, the same for every viewer
+        "fps": int(metrics.capture_fps()),
+        "euler": euler,
+        "temp": temp,
+        "alt": alt,
+    }
+
+
+def render_overlay(frame, key):
+    # Draws the overlay for the display config in key.mode on a private copy
+    # of the frame. Returns None when the frame should not be streamed.
+    mode = key.mode
+    if mode == 0:
+        layouts.render(frame, telemetry())
+    elif mode == 1:
+        compositor.apply(frame, mode)
+    elif mode == HIDDEN_CONFIG:
+        return None
+    return frame
+
+
+def current_display_config():
+    return display_config
+
+
+snapshot_writer = SnapshotWriter()
+
+
+def save_snapshot(im):
+    # save snapshot when button is pressed down. The image is already in JPEG
+    # format, the writer thread puts it on disk so the stream never waits
+    snapshot_writer.submit(im)
+
+
+def frame_streamed(jpg):
+    # Called by both server backends for every frame sent to a client
+    global take_snapshot
+    if take_snapshot:
+        save_snapshot(jpg.data)
+        take_snapshot = False
 
 
 class CameraHandler(BaseHTTPRequestHandler):
     def __init__(self, request, client_address, server):
         self.document_root = server.get_document_root()
         self.camera = server.get_camera()
-        # https://www.tutorialkart.com/opencv/python/opencv-python-get-image-size/
-        self.frame_shape = self.camera.get_frame(SLEEP_IN_SEC).shape
+        self.encoder = server.get_encode_cache()
+        # Known when the server starts, a request never waits on the camera
+        # unless it streams from it
+        self.frame_shape = server.frame_shape
         super(CameraHandler, self).__init__(request, client_address, server)
 
     def flash_message(self, text, frame, pos_x=int(200), pos_y=int(20), duration=3):
@@ -86,100 +194,220 @@ class CameraHandler(BaseHTTPRequestHandler):
         )
 
     def save_snapshot(self, im):
-        # save snapshot when button is pressed down
-        file_path = "snapshots/" + str(uuid.uuid1()) + ".jpg"
-        # write snapshot to file (we use image value instead of camera because it's already in JPEG format)
-        with open(file_path, "wb") as f:
-            f.write(im)
-
-    def do_GET(self):
-        if self.path == URL_PATH_MJPG:
-            self.send_response(200)
-
-            self.send_header(
-                "Content-type", "multipart/x-mixed-replace; boundary=--jpgboundary"
-            )
-            self.end_headers()
-            while self.camera.is_opened():
-                global diff_fps, flash_message, take_snapshot
-                start_fps = time.time()
-                frame = self.camera.get_frame(SLEEP_IN_SEC)
-                # Does not work
-
-                if display_config == 0:
-                    # Debug drawing to see which display config is active
-                    overlay_lib.draw_text(
-                        frame,
-                        100,
-                        100,
-                        "d: " + str(display_config),
-                        self.frame_shape[1],
-                        self.frame_shape[0],
-                    )
-
-                    overlay_lib.drawCrosshair(
-                        frame, self.frame_shape[1], self.frame_shape[0]
-                    )
-                    overlay_lib.draw_joy(
-                        frame, x, y, self.frame_shape[1], self.frame_shape[0]
-                    )
-                    overlay_lib.draw_power(
-                        frame, power_info, self.frame_shape[1], self.frame_shape[0]
+        save_snapshot(im)
+
+    def stream(self, session):
+        while self.camera.is_opened():
+            # Always the newest frame, whatever was captured while the
+            # previous one was being written is dropped
+            shared = session.next_frame(self.camera, FRAME_TIMEOUT_IN_SEC)
+            if shared is None:
+                continue
+            # Overlay and encoding are done once per frame, display config
+            # and quality tier, clients on the same tier share the bytes
+            jpg = self.encoder.get(session.key(display_config), shared)
+            if jpg is None or not session.is_new(jpg):
+                continue
+            frame_streamed(jpg)
+
+            start_send = time.time()
+            # Header and JPEG in one sendmsg(), the header is built once per
+            # frame for all clients and the JPEG bytes are not copied
+            send_parts(self.connection, (jpg.part_header, jpg.data))
+            session.sent(jpg.nbytes, time.time() - start_send)
+
+    def websocket(self, session):
+        # One binary message per frame, at most window.size of them waiting
+        # for an ack. Acks are read on their own thread.
+        window = AckWindow()
+        cond = threading.Condition()
+        write_lock = threading.Lock()
+
+        def send(*parts):
+            with write_lock:
+                send_parts(self.connection, parts)
+
+        acks = AckReader(self.connection.recv, send, window, cond)
+        acks.start()
+        try:
+            while self.camera.is_opened() and not acks.closed:
+                with cond:
+                    ready = cond.wait_for(
+                        lambda: acks.closed or window.can_send(), ACK_TIMEOUT_IN_SEC
                     )
-                    overlay_lib.draw_CPU(
-                        frame, CPU_info, self.frame_shape[1], self.frame_shape[0]
-                    )
-                    overlay_lib.draw_FPS(
-                        frame,
-                        "FPS: " + str(int(1 / float(diff_fps))),
-                        self.frame_shape[1],
-                        self.frame_shape[0],
-                    )
-                    overlay_lib.draw_IMU(
-                        frame,
-                        euler,
-                        temp,
-                        alt,
-                        self.frame_shape[1],
-                        self.frame_shape[0],
-                    )
-
-                    # self.camera.draw_power2(frame, "AAA")
-
-                elif display_config == 1:
-                    overlay_lib.drawCrosshair(
-                        frame, self.frame_shape[1], self.frame_shape[0]
-                    )
-                elif display_config == 2:
+                    if not ready:
+                        window.expire()
+                        continue
+                shared = session.next_frame(self.camera, FRAME_TIMEOUT_IN_SEC)
+                if shared is None:
                     continue
-
-                ret, jpg = cv2.imencode(".jpg", frame)
-                if take_snapshot:
-                    self.save_snapshot(jpg)
-                    take_snapshot = False
-
-                # jpg = self.camera.read_in_jpeg(SLEEP_IN_SEC, 1 / diff_fps)
-                if jpg is None:
+                jpg = self.encoder.get(session.key(display_config), shared)
+                if jpg is None or not session.is_new(jpg):
                     continue
-                self.wfile.write("--jpgboundary".encode())
+                frame_streamed(jpg)
+                start_send = time.time()
+                with cond:
+                    window.sent(jpg.seq)
+                send(video_head(jpg), jpg.data)
+                session.sent(jpg.nbytes, time.time() - start_send)
+        finally:
+            acks.closed = True
+
+    def reject(self):
+        # max_clients are streaming already
+        self.send_response(503)
+        self.send_header("Retry-After", str(RETRY_AFTER_IN_SEC))
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+    def playback(self, cursor):
+        while True:
+            frame = cursor.next()
+            if frame is None:
+                break
+            delay, timestamp, jpeg = frame
+            if delay:
+                time.sleep(delay)
+            send_parts(self.connection, (part_header(len(jpeg)), jpeg))
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == URL_PATH_PLAYBACK:
+            try:
+                session_dir, t, speed = parse_playback_query(
+                    self.path, self.server.record_dir
+                )
+            except PlaybackError as e:
+                self.send_response(404)
+                self.end_headers()
+                self.wfile.write(str(e).encode())
+                return
+            if not self.server.clients.acquire():
+                self.reject()
+                return
+            try:
+                self.send_response(200)
+                self.send_header("Content-type", MULTIPART_TYPE)
+                self.end_headers()
+                configure_stream_socket(self.connection)
+                cursor = PlaybackCursor(session_dir, t, speed)
+                try:
+                    self.playback(cursor)
+                except (ConnectionError, socket.timeout) as e:
+                    logger.info("playback client gone: {error}".format(error=e))
+                finally:
+                    cursor.close()
+            finally:
+                self.server.clients.release()
+
+        elif self.path.split("?", 1)[0] == URL_PATH_WS:
+            headers = {name.lower(): value for name, value in self.headers.items()}
+            try:
+                variant = parse_variant(self.path)
+                response = handshake(headers)
+            except (VariantError, WebSocketError) as e:
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode())
+                return
+            if not self.server.clients.acquire():
+                self.reject()
+                return
+            try:
+                self.wfile.write(response)
+                configure_stream_socket(self.connection)
+                session = StreamSession(
+                    self.client_address, self.server.quality_tiers, variant
+                )
+                try:
+                    self.websocket(session)
+                except (ConnectionError, socket.timeout) as e:
+                    logger.info("websocket client gone: {error}".format(error=e))
+                finally:
+                    session.close()
+                logger.info(session.summary())
+            finally:
+                self.server.clients.release()
+
+        elif self.path.split("?", 1)[0] == URL_PATH_SNAPSHOT:
+            try:
+                variant = parse_variant(self.path)
+            except VariantError as e:
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode())
+                return
+            key = still_key(variant, display_config, self.server.quality_tiers)
+            status, jpg = still_frame(
+                self.camera, self.encoder, key, self.headers.get("If-None-Match")
+            )
+            self.send_response(status)
+            if jpg is not None:
+                # A 304 carries the ETag too
+                self.send_header("ETag", etag(jpg.seq))
+                self.send_header("Cache-Control", "no-cache")
+            if status == 200:
                 self.send_header("Content-type", "image/jpeg")
                 self.send_header("Content-length", str(jpg.nbytes))
                 self.end_headers()
-                self.wfile.write(jpg)
-                endtime_fps = time.time()
-                diff_fps = endtime_fps - start_fps
+                self.wfile.write(jpg.data)
+            else:
+                self.send_header("Content-length", "0")
+                self.end_headers()
+
+        elif self.path.split("?", 1)[0] == URL_PATH_MJPG:
+            # Clients asking for the same scale, fps, quality and overlay
+            # share one resize, overlay and encode per frame
+            try:
+                variant = parse_variant(self.path)
+            except VariantError as e:
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode())
+                return
+            if not self.server.clients.acquire():
+                self.reject()
+                return
+            try:
+                self.send_response(200)
+
+                self.send_header("Content-type", MULTIPART_TYPE)
+                self.end_headers()
+                configure_stream_socket(self.connection)
+                session = StreamSession(
+                    self.client_address, self.server.quality_tiers, variant
+                )
+                try:
+                    self.stream(session)
+                except (ConnectionError, socket.timeout) as e:
+                    logger.info("stream client gone: {error}".format(error=e))
+                finally:
+                    session.close()
+                logger.info(session.summary())
+            finally:
+                self.server.clients.release()
+
+        elif self.path == URL_PATH_METRICS:
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header("Content-type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
         elif self.path == URL_PATH_FAVICON:
             self.send_response(404)
             self.end_headers()
             self.wfile.write("favicon is not found".encode())
+        elif self.server.index_html is None:
+            self.send_response(404)
+            self.end_headers()
+            self.wfile.write("index.html is not found".encode())
         else:
             self.send_response(200)
             self.send_header("Content-type", "text/html")
+            self.send_header("Content-length", str(len(self.server.index_html)))
             self.end_headers()
-            with open(self.document_root + "/index.html", "r") as f:
-
-                self.wfile.write(f.read().encode())
+            self.wfile.write(self.server.index_html)
         logger.info("thread is stopping ... [{path}]".format(path=self.path))
 
 
@@ -276,7 +504,30 @@ class Robot_Info(Node):
         self.press_topic = self.create_subscription(
             FluidPressure, "/press", self.press_topic, 10
         )
+        self.save_clip_service = self.create_service(
+            Trigger, "save_clip", self.save_clip_service
+        )
         self.init_buttons = True
+        self.clip_button = 0
+        # Capture pipeline, e.g. --ros-args -p pipeline.framerate:=30
+        for name, value in PIPELINE_SETTINGS.items():
+            self.declare_parameter("pipeline." + name, value)
+        # sensor_msgs/CompressedImage topic, e.g.
+        # --ros-args -p compressed_image.enabled:=true
+        for name, value in IMAGE_SETTINGS.items():
+            self.declare_parameter("compressed_image." + name, value)
+
+    def pipeline_settings(self):
+        return {
+            name: self.get_parameter("pipeline." + name).value
+            for name in PIPELINE_SETTINGS
+        }
+
+    def image_settings(self):
+        return {
+            name: self.get_parameter("compressed_image." + name).value
+            for name in IMAGE_SETTINGS
+        }
 
     def imu_topic(self, msg):
         global euler
@@ -314,6 +565,17 @@ class Robot_Info(Node):
         take_snapshot = True
         # print("SNAP!!!!" + str(argum))
 
+    def save_clip(self):
+        if clip_buffer is None:
+            return None
+        return clip_buffer.trigger()
+
+    def save_clip_service(self, request, response):
+        name = self.save_clip()
+        response.success = name is not None
+        response.message = name if name is not None else "clip buffer is disabled"
+        return response
+
     def change_view(self):
         global display_config
         print(display_config)
@@ -326,7 +588,12 @@ class Robot_Info(Node):
         global x, y, display_config
         x = round(msg.axes[0], 1)
         y = round(msg.axes[1], 1)
-        display_change_button = msg.buttons[9]
+        display_change_button = msg.buttons[DISPLAY_BUTTON]
+        # Only the press starts a clip, holding the button does not
+        clip_button = msg.buttons[CLIP_BUTTON]
+        if clip_button == 1 and self.clip_button == 0:
+            self.save_clip()
+        self.clip_button = clip_button
 
         if display_change_button == 1:
             self.change_view()
@@ -348,12 +615,29 @@ class Robot_Info(Node):
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     def set_camera(self, camera):
         self.camera = camera
+        self.frame_shape = (camera.height, camera.width, 3)
 
     def get_camera(self):
         return self.camera
 
+    def set_encode_cache(self, encoder):
+        self.encoder = encoder
+
+    def get_encode_cache(self):
+        return self.encoder
+
+    def set_quality_tiers(self, quality_tiers):
+        self.quality_tiers = quality_tiers
+
+    def set_record_dir(self, record_dir):
+        self.record_dir = record_dir
+
+    def set_max_clients(self, max_clients):
+        self.clients = ClientLimit(max_clients)
+
     def set_document_root(self, document_root):
         self.document_root = document_root
+        self.index_html = load_index(document_root)
 
     def get_document_root(self):
         return self.document_root
@@ -455,20 +739,143 @@ def main(args=None):
     parser.add_argument("--width", type=int, default=640)
     parser.add_argument("--height", type=int, default=480)
     parser.add_argument("--directory", type=str, default="html")
+    # "jetson" for the CSI camera, "test" for a GStreamer test pattern or a
+    # V4L2 device number. The pipeline is set with the pipeline.* parameters
     parser.add_argument("--device", type=str, default="jetson")
-    args = parser.parse_args()
+    # "threaded" starts one thread per connection, "asyncio" serves every
+    # client from a single event loop
+    parser.add_argument(
+        "--backend", type=str, default="threaded", choices=["threaded", "asyncio"]
+    )
+    # JPEG quality bounds for the adaptive stream, set both to the same value
+    # to disable it. A --min-scale below 1 also lets slow clients get a
+    # smaller picture once they are at the lowest quality.
+    parser.add_argument("--min-quality", type=int, default=40)
+    parser.add_argument("--max-quality", type=int, default=90)
+    parser.add_argument("--quality-step", type=int, default=10)
+    parser.add_argument("--min-scale", type=float, default=1.0)
+    # Render telemetry text from cached bitmaps instead of cv2.putText. Slower
+    # than putText on x86, see benchmark/bench_overlay.py on the target
+    parser.add_argument("--text-cache", action="store_true")
+    # JSON overlay layout, reloaded whenever the file changes
+    parser.add_argument("--layout", type=str, default=None)
+    # Skip encoding frames that differ from the last one sent by less than
+    # this many grey levels on average, 0 encodes every frame. Unchanged
+    # pictures are still sent every --keepalive-seconds.
+    parser.add_argument("--skip-unchanged", type=float, default=0.0)
+    parser.add_argument("--keepalive-seconds", type=float, default=1.0)
+    # Encode JPEGs in this many worker processes, 0 encodes in the node
+    parser.add_argument("--encode-workers", type=int, default=0)
+    # Streaming clients served at once, the next ones get a 503, 0 is no limit
+    parser.add_argument("--max-clients", type=int, default=0)
+    parser.add_argument("--snapshot-dir", type=str, default="snapshots")
+    parser.add_argument("--snapshot-quota-mb", type=int, default=512)
+    # Seconds of encoded video kept in memory for clips, 0 disables it. A clip
+    # also has --clip-post-seconds after the trigger and goes to
+    # <snapshot-dir>/clips
+    parser.add_argument("--clip-seconds", type=float, default=0.0)
+    parser.add_argument("--clip-post-seconds", type=float, default=3.0)
+    parser.add_argument("--clip-budget-mb", type=int, default=64)
+    # Continuous recording to rotating segments in <record-dir>/<session>
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--record-dir", type=str, default="recordings")
+    parser.add_argument("--segment-seconds", type=float, default=60.0)
+    parser.add_argument("--record-quota-mb", type=int, default=4096)
+    # Share the raw frames with other local processes through /dev/shm
+    parser.add_argument("--frame-bus", action="store_true")
+    parser.add_argument("--frame-bus-name", type=str, default=BUS_NAME)
+    args = parser.parse_args(remove_ros_args(sys.argv)[1:])
+
+    overlay_lib.use_text_cache = args.text_cache
+    global layouts, snapshot_writer, clip_buffer
+    layouts = LayoutManager(args.layout)
+    snapshot_writer = SnapshotWriter(
+        args.snapshot_dir, args.snapshot_quota_mb * 1024 * 1024
+    )
+    snapshot_writer.start()
+
+    # The node is created first, its parameters configure the capture
+    r_info = Robot_Info()
+    camera = Camera(args.device, args.width, args.height, r_info.pipeline_settings())
+    camera.start()
+    frame_bus = None
+    if args.frame_bus:
+        frame_bus = FrameBusWriter(camera, args.frame_bus_name)
+        frame_bus.start()
+    detector = None
+    if args.skip_unchanged > 0:
+        detector = ChangeDetector(args.skip_unchanged, args.keepalive_seconds)
+    encode_pool = None
+    if args.encode_workers > 0:
+        encode_pool = EncodePool(args.encode_workers)
+        encode_pool.start()
+    encoder = EncodeCache(render_overlay, detector=detector, encode_pool=encode_pool)
+    tiers = quality_tiers(
+        args.min_quality, args.max_quality, args.quality_step, args.min_scale
+    )
 
-    # The parameter "--device" can be integer 0, 1, 2 etc or a string if tis is "jetson" we wil use the jetson caemra as capture device
-    camera = Camera(args.device, args.width, args.height)
+    def pump_key():
+        # Clips, recordings and the image topic get what the pilot watches on
+        # the best tier, so with a client connected they reuse its encode.
+        # Hiding the video must not stop them, they get the bare picture then.
+        mode = display_config
+        if mode == HIDDEN_CONFIG:
+            mode = PLAIN_MODE
+        return default_key(mode, tiers)
+
+    # With encode workers the pump keeps the pilot's next frames in flight
+    # while anybody streams, a client then waits for one encode at most
+    prefetch = metrics.session_count if encode_pool is not None else None
+    pump = EncodePump(camera, encoder, pump_key, prefetch)
+    if args.clip_seconds > 0:
+        clip_buffer = ClipBuffer(
+            snapshot_writer,
+            args.clip_seconds,
+            args.clip_post_seconds,
+            args.clip_budget_mb * 1024 * 1024,
+        )
+        pump.add_sink(clip_buffer.push)
+    recorder = None
+    if args.record:
+        recorder = SegmentRecorder(
+            args.record_dir,
+            args.segment_seconds,
+            quota_bytes=args.record_quota_mb * 1024 * 1024,
+        )
+        recorder.start()
+        pump.add_sink(recorder.push)
+    image_publisher = None
+    image_settings = r_info.image_settings()
+    if image_settings["enabled"]:
+        image_publisher = CompressedImagePublisher(r_info, pump, image_settings)
+    pump.start()
     try:
-        server = ThreadedHTTPServer((args.bind, args.port), CameraHandler)
-        server.set_camera(camera)
-        server.set_document_root(args.directory)
-        logger.info("server started")
+        if args.backend == "asyncio":
+            server = AsyncStreamServer(
+                camera,
+                encoder,
+                args.directory,
+                tiers,
+                current_display_config,
+                frame_streamed,
+                args.record_dir,
+                args.max_clients,
+            )
+            thread2 = threading.Thread(
+                target=server.serve_forever, args=(args.bind, args.port)
+            )
+        else:
+            server = ThreadedHTTPServer((args.bind, args.port), CameraHandler)
+            server.set_camera(camera)
+            server.set_encode_cache(encoder)
+            server.set_quality_tiers(tiers)
+            server.set_document_root(args.directory)
+            server.set_record_dir(args.record_dir)
+            server.set_max_clients(args.max_clients)
+            thread2 = threading.Thread(target=server.serve_forever)
+        logger.info("server started ({backend})".format(backend=args.backend))
 
-        thread2 = threading.Thread(target=server.serve_forever)
         thread2.start()
-        r_info = Robot_Info()
 
         # server.serve_forever()
         # Setup and start the thread to read serial port    r_info = Robot_Info()
@@ -480,8 +887,23 @@ def main(args=None):
 
     except KeyboardInterrupt:
         logger.info("server is stopping ...")
-        camera.release()
         server.shutdown()
+    finally:
+        # The pump stops feeding the sinks before the writers are stopped,
+        # they then flush, close and fsync what they have queued
+        camera.release()
+        pump.stop()
+        pump.join()
+        if recorder is not None:
+            recorder.stop()
+        snapshot_writer.stop()
+        if encode_pool is not None:
+            encode_pool.close()
+        if frame_bus is not None:
+            frame_bus.stop()
+            frame_bus.join()
+        if image_publisher is not None:
+            image_publisher.destroy()
 
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
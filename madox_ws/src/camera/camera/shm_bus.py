@@ -0,0 +1,237 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .camera import FRAME_TIMEOUT_IN_SEC
+from .log import logger
+
+# Shared memory files live in tmpfs, the name is what readers open
+SHM_DIR = "/dev/shm"
+BUS_NAME = "madox_camera"
+# Frames kept in the ring. A reader has about BUS_SLOTS / fps seconds to
+# use a frame before the writer comes back to its slot.
+BUS_SLOTS = 4
+MAGIC = b"MDXBUS1\0"
+# magic, slots, height, width, channels, latest seq
+BUS_HEADER = struct.Struct("<8sIIIIQ")
+LATEST_OFFSET = 24
+# Slots start on a page, their pixels on a cache line
+PAGE_BYTES = 4096
+SLOT_HEADER_BYTES = 64
+# Seqlock generation, odd while the slot is being written, then the frame's
+# sequence number and capture time
+SLOT_HEADER = struct.Struct("<QQd")
+# How often a waiting reader looks at the latest sequence number
+POLL_IN_SEC = 0.002
+
+BusFrame = namedtuple("BusFrame", ["seq", "timestamp", "image", "slot", "generation"])
+
+
+class FrameBusError(ValueError):
+    pass
+
+
+def bus_path(name):
+    return os.path.join(SHM_DIR, name)
+
+
+def slot_stride(height, width, channels):
+    size = SLOT_HEADER_BYTES + height * width * channels
+    return (size + PAGE_BYTES - 1) // PAGE_BYTES * PAGE_BYTES
+
+
+def slot_offset(index, stride):
+    return PAGE_BYTES + index * stride
+
+
+class FrameBusWriter(threading.Thread):
+    """Publishes the camera frames to other processes through shared memory.
+
+    Every captured frame is copied into the next slot of a ring in an
+    mmap'd file under /dev/shm, the bus header then points at it. The file
+    is created on the first frame with its shape, and created again if the
+    shape changes. A FrameBusReader in another process maps the same file
+    read-only and uses the pixels in place.
+    """
+
+    def __init__(self, camera, name=BUS_NAME, slots=BUS_SLOTS):
+        super().__init__(name="frame-bus", daemon=True)
+        self.camera = camera
+        self.path = bus_path(name)
+        self.slots = slots
+        self._map = None
+        self._shape = None
+        self._stride = 0
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        seq = 0
+        while self._running and self.camera.is_opened():
+            frame = self.camera.wait_frame(seq, FRAME_TIMEOUT_IN_SEC)
+            if frame is None:
+                continue
+            seq = frame.seq
+            if not frame.retain():
+                continue
+            try:
+                self.write(frame.image, frame.seq, frame.timestamp)
+            finally:
+                frame.release()
+        self._close()
+
+    def write(self, image, seq, timestamp):
+        if image.ndim == 2:
+            image = image[:, :, None]
+        if image.shape != self._shape:
+            self._create(image.shape)
+        offset = slot_offset(seq % self.slots, self._stride)
+        (generation,) = struct.unpack_from("<Q", self._map, offset)
+        # Odd while the pixels are changing, a reader seeing it retries
+        struct.pack_into("<Q", self._map, offset, generation + 1)
+        pixels = np.ndarray(
+            self._shape, np.uint8, self._map, offset + SLOT_HEADER_BYTES
+        )
+        np.copyto(pixels, image)
+        del pixels
+        SLOT_HEADER.pack_into(self._map, offset, generation + 2, seq, timestamp)
+        struct.pack_into("<Q", self._map, LATEST_OFFSET, seq)
+
+    def _create(self, shape):
+        self._close()
+        height, width, channels = shape
+        self._stride = slot_stride(height, width, channels)
+        size = slot_offset(self.slots, self._stride)
+        # A new file rather than resizing the old one, readers still
+        # mapping it notice it was replaced and open this one
+        tmp = "{}.{}".format(self.path, os.getpid())
+        fd = os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        BUS_HEADER.pack_into(
+            self._map, 0, MAGIC, self.slots, height, width, channels, 0
+        )
+        os.replace(tmp, self.path)
+        self._shape = shape
+        logger.info(
+            "frame bus {} {}x{}x{}, {} slots".format(
+                self.path, width, height, channels, self.slots
+            )
+        )
+
+    def _close(self):
+        if self._map is None:
+            return
+        self._map.close()
+        self._map = None
+        self._shape = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FrameBusReader(object):
+    """Maps the frame bus of the camera node read-only.
+
+    read() waits for a frame newer than last_seq and returns a BusFrame
+    whose image is a read-only view of the shared slot: nothing is copied.
+    The writer reuses the slot BUS_SLOTS frames later, so a reader that
+    keeps the view calls valid(frame) after using the pixels and drops the
+    result when it returns False. read(copy=True) returns a private copy
+    that is already checked.
+
+        bus = FrameBusReader()
+        frame = bus.read(timeout=1.0)
+        mask = cv2.inRange(frame.image, low, high)
+        if bus.valid(frame):
+            follow(mask)
+    """
+
+    def __init__(self, name=BUS_NAME):
+        self.path = bus_path(name)
+        self._map = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self._inode = os.fstat(fd).st_ino
+            size = os.fstat(fd).st_size
+            bus = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, slots, height, width, channels, _ = BUS_HEADER.unpack_from(bus, 0)
+        if magic != MAGIC:
+            bus.close()
+            raise FrameBusError("{} is not a frame bus".format(self.path))
+        self.close()
+        self._map = bus
+        self.slots = slots
+        self.shape = (height, width, channels)
+        self._stride = slot_stride(height, width, channels)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Views handed out are still alive, the mapping goes with them
+                pass
+            self._map = None
+
+    def latest_seq(self):
+        return struct.unpack_from("<Q", self._map, LATEST_OFFSET)[0]
+
+    def replaced(self):
+        # True when the camera node restarted or changed the resolution
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def read(self, last_seq=0, timeout=None, copy=False):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            seq = self.latest_seq()
+            if seq > last_seq:
+                frame = self._frame(seq, copy)
+                if frame is not None:
+                    return frame
+            elif self.replaced():
+                self._open()
+                last_seq = 0
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_IN_SEC)
+
+    def _frame(self, seq, copy):
+        slot = seq % self.slots
+        offset = slot_offset(slot, self._stride)
+        generation, slot_seq, timestamp = SLOT_HEADER.unpack_from(self._map, offset)
+        if generation % 2 or slot_seq != seq:
+            # Being overwritten already
+            return None
+        image = np.ndarray(self.shape, np.uint8, self._map, offset + SLOT_HEADER_BYTES)
+        frame = BusFrame(seq, timestamp, image, slot, generation)
+        if copy:
+            frame = frame._replace(image=image.copy())
+            if not self.valid(frame):
+                return None
+        return frame
+
+    def valid(self, frame):
+        # The slot has not been written since the frame was read
+        offset = slot_offset(frame.slot, self._stride)
+        return struct.unpack_from("<Q", self._map, offset)[0] == frame.generation
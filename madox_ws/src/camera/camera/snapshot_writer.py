@@ -0,0 +1,135 @@
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+
+from .log import logger
+
+SNAPSHOT_DIR = "snapshots"
+QUOTA_BYTES = 512 * 1024 * 1024
+QUEUE_SIZE = 32
+# Files written before the directory entries are synced in one go
+BATCH_SIZE = 8
+
+
+class SnapshotWriter(threading.Thread):
+    """Writes already-encoded images to disk on a dedicated thread.
+
+    submit() only puts the buffer in a bounded queue and never blocks the
+    caller: when the queue is full the snapshot is dropped and logged. The
+    thread writes queued files in batches, fsyncs each file and the directory
+    once per batch, and keeps the total size of the directory under a quota
+    by deleting the oldest files. The size of every file is tracked in
+    memory, the directory is only scanned once at start-up.
+    """
+
+    def __init__(
+        self,
+        directory=SNAPSHOT_DIR,
+        quota_bytes=QUOTA_BYTES,
+        queue_size=QUEUE_SIZE,
+        batch_size=BATCH_SIZE,
+    ):
+        super().__init__(name="snapshot-writer", daemon=True)
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        # path -> size, oldest first
+        self._index = OrderedDict()
+        self._total = 0
+
+    def submit(self, data, name=None):
+        # name is relative to the snapshot directory, a unique .jpg by default.
+        # data is a bytes-like object or a list of them written back to back
+        if name is None:
+            name = str(uuid.uuid1()) + ".jpg"
+        try:
+            self.queue.put_nowait((name, data))
+        except queue.Full:
+            self.dropped += 1
+            logger.info("snapshot queue full, dropped {}".format(name))
+            return False
+        return True
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            stop = batch[-1] is None
+            self._write_batch([entry for entry in batch if entry is not None])
+            if stop:
+                return
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self._total += size
+        self._enforce_quota()
+
+    def _write_batch(self, batch):
+        directories = set()
+        for name, data in batch:
+            path = os.path.join(self.directory, name)
+            directory = os.path.dirname(path)
+            try:
+                if directory not in directories:
+                    os.makedirs(directory, exist_ok=True)
+                parts = data if isinstance(data, (list, tuple)) else [data]
+                with open(path, "wb") as f:
+                    for part in parts:
+                        f.write(part)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.info("cannot write snapshot {}: {}".format(path, e))
+                continue
+            directories.add(directory)
+            size = sum(len(part) for part in parts)
+            self._total += size - self._index.pop(path, 0)
+            self._index[path] = size
+        # New directory entries are made durable once per batch
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._enforce_quota()
+
+    def _enforce_quota(self):
+        while self._total > self.quota_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
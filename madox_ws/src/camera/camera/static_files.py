@@ -0,0 +1,18 @@
+import os
+
+from .log import logger
+
+INDEX_FILE = "index.html"
+URL_PATH_FAVICON = "/favicon.ico"
+
+
+def load_index(document_root):
+    # Read once when the server starts, not on every page load. None when
+    # the file is missing, the page is then answered with a 404.
+    path = os.path.join(document_root, INDEX_FILE)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.warning("cannot read {path}: {error}".format(path=path, error=e))
+        return None
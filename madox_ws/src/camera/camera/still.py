@@ -0,0 +1,61 @@
+from .encoder import PLAIN_MODE, StreamKey
+
+URL_PATH_SNAPSHOT = "/snapshot.jpg"
+
+
+def etag(seq):
+    return '"{}"'.format(seq)
+
+
+def etag_matches(if_none_match, seq):
+    # If-None-Match is "*" or a list of entity tags, a weak one matches too
+    tag = etag(seq)
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", tag):
+            return True
+    return False
+
+
+def still_key(variant, mode, tiers):
+    # Stills use the best tier unless the URL pins quality or scale, like
+    # the stream they come from
+    quality, scale = tiers[0]
+    if variant.overlay is False:
+        mode = PLAIN_MODE
+    if variant.quality is not None:
+        quality = variant.quality
+    if variant.scale is not None:
+        scale = variant.scale
+    return StreamKey(mode, quality, scale)
+
+
+def still_frame(camera, encoder, key, if_none_match=None):
+    """Newest encoded frame for a /snapshot.jpg request.
+
+    Returns (304, EncodedFrame) when the client already has the JPEG that
+    would be served, or sent If-None-Match: *, so its ETag can be sent
+    again. Returns (200, EncodedFrame) otherwise and (503, None) when there
+    is no frame to serve. The camera is never read: the frame comes from the
+    capture thread's slot and the JPEG from the EncodeCache, so a frame
+    already encoded for a stream client on the same key costs nothing and
+    any other frame is encoded at most once.
+
+    The ETag is the sequence number of the EncodedFrame, not of the latest
+    capture: with a ChangeDetector, an fps key or a stale capture buffer
+    the cache keeps handing out an older frame, and a client polling a
+    parked robot must get 304 for it.
+    """
+    frame = camera.latest_frame()
+    if frame is None:
+        return 503, None
+    encoded = encoder.latest(key)
+    if encoded is None or encoded.seq < frame.seq:
+        encoded = encoder.get(key, frame)
+    if encoded is None:
+        return 503, None
+    if if_none_match is not None and etag_matches(if_none_match, encoded.seq):
+        return 304, encoded
+    return 200, encoded
@@ -0,0 +1,157 @@
+import socket
+import threading
+import time
+
+from .encoder import PLAIN_MODE, StreamKey
+from .metrics import SECONDS_BUCKETS, Histogram, metrics
+from .quality import QualityController
+from .variants import DEFAULT_VARIANT
+
+# Kernel send buffer for stream sockets. Kept to a couple of frames so a slow
+# viewer blocks in write() instead of queueing seconds of stale video.
+SEND_BUFFER_BYTES = 128 * 1024
+# A client that cannot take a single frame within this time is dropped
+WRITE_TIMEOUT_IN_SEC = 5.0
+# Weight of the newest sample in the moving average of the send time
+SEND_TIME_SMOOTHING = 0.2
+# Told to clients turned away because max_clients are already streaming
+RETRY_AFTER_IN_SEC = 5
+
+
+def default_key(mode, tiers):
+    # Key of a client with the default variant on the best tier, what the
+    # pilot's browser asks for while its link keeps up
+    quality, scale = tiers[0]
+    return StreamKey(mode, quality, scale)
+
+
+def _limit_send_buffer(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def configure_stream_socket(sock):
+    _limit_send_buffer(sock)
+    sock.settimeout(WRITE_TIMEOUT_IN_SEC)
+
+
+def configure_stream_writer(writer):
+    # The asyncio backend times its writes out itself. The transport buffers
+    # no more than the kernel on top of it, so slow clients drop frames
+    # instead of queueing them like with the threaded server.
+    _limit_send_buffer(writer.get_extra_info("socket"))
+    writer.transport.set_write_buffer_limits(high=SEND_BUFFER_BYTES)
+
+
+class ClientLimit(object):
+    """Bounds the number of streaming clients, 0 is no limit.
+
+    acquire() returns False instead of blocking when the limit is reached,
+    the request is then answered with a 503. Every successful acquire() is
+    paired with a release() when the stream ends.
+    """
+
+    def __init__(self, max_clients=0):
+        self.max_clients = max_clients
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.max_clients and self.active >= self.max_clients:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class StreamSession(object):
+    """State of one streaming client.
+
+    The session never queues frames: every call to next_frame() returns the
+    newest frame available and counts the ones that were skipped while the
+    client was busy writing the previous one. Its QualityController adapts
+    the JPEG quality and scale to what the client's link can carry, unless
+    the client pinned them in its StreamVariant.
+    """
+
+    def __init__(self, client_address, tiers, variant=DEFAULT_VARIANT):
+        self.client = "%s:%s" % tuple(client_address[:2])
+        self.quality = QualityController(tiers)
+        self.variant = variant
+        self.last_encoded_seq = 0
+        self.started = time.time()
+        self.last_seq = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.send_time = 0.0
+        self.last_send_time = 0.0
+        self.avg_send_time = 0.0
+        self.write_latency = Histogram(
+            "camera_client_write_seconds",
+            "Time spent writing a frame to a stream client",
+            SECONDS_BUCKETS,
+        )
+        metrics.add_session(self)
+
+    def close(self):
+        metrics.remove_session(self)
+
+    def next_frame(self, camera, timeout):
+        return self.advance(camera.wait_frame(self.last_seq, timeout))
+
+    def advance(self, frame):
+        if frame is None or frame.seq <= self.last_seq:
+            return None
+        if self.last_seq:
+            self.frames_dropped += frame.seq - self.last_seq - 1
+        self.last_seq = frame.seq
+        return frame
+
+    def key(self, mode):
+        variant = self.variant
+        if variant.overlay is False:
+            mode = PLAIN_MODE
+        quality = self.quality.quality if variant.quality is None else variant.quality
+        scale = self.quality.scale if variant.scale is None else variant.scale
+        return StreamKey(mode, quality, scale, variant.fps)
+
+    def is_new(self, encoded):
+        # A frame rate limited key hands out the same frame until the next
+        # one is due, it is only sent once
+        if encoded.seq == self.last_encoded_seq:
+            return False
+        self.last_encoded_seq = encoded.seq
+        return True
+
+    def sent(self, nbytes, elapsed):
+        self.quality.update(nbytes, elapsed)
+        self.write_latency.observe(elapsed)
+        self.frames_sent += 1
+        self.bytes_sent += nbytes
+        self.send_time += elapsed
+        self.last_send_time = elapsed
+        if self.frames_sent == 1:
+            self.avg_send_time = elapsed
+        else:
+            self.avg_send_time += SEND_TIME_SMOOTHING * (elapsed - self.avg_send_time)
+
+    def summary(self):
+        duration = max(time.time() - self.started, 1e-6)
+        return (
+            "{client}: {sent} frames sent, {dropped} dropped, "
+            "{kbps:.0f} kB/s, avg send {send_ms:.1f} ms, "
+            "quality {quality} scale {scale}".format(
+                client=self.client,
+                sent=self.frames_sent,
+                dropped=self.frames_dropped,
+                kbps=self.bytes_sent / duration / 1024,
+                send_ms=self.avg_send_time * 1000,
+                quality=self.quality.quality,
+                scale=self.quality.scale,
+            )
+        )
@@ -0,0 +1,46 @@
+from collections import namedtuple
+from urllib.parse import parse_qs, urlsplit
+
+MIN_SCALE = 0.1
+MAX_FPS = 60.0
+
+# What a client pinned in the stream URL, None leaves the setting to the
+# server: scale and quality to the client's QualityController, overlay to
+# the current display config. fps 0 means every captured frame.
+StreamVariant = namedtuple("StreamVariant", ["scale", "fps", "quality", "overlay"])
+DEFAULT_VARIANT = StreamVariant(None, 0, None, None)
+
+
+class VariantError(ValueError):
+    pass
+
+
+def _number(query, name, convert, low, high):
+    if name not in query:
+        return None
+    try:
+        value = convert(query[name][0])
+    except ValueError:
+        raise VariantError("{} must be a number".format(name))
+    if not low <= value <= high:
+        raise VariantError("{} must be in [{}, {}]".format(name, low, high))
+    return value
+
+
+def parse_variant(path):
+    """Reads the variant from /camera.mjpg?scale=0.5&fps=5&quality=40&overlay=0.
+
+    Values are rounded so that near identical URLs share the same encode
+    instead of each starting their own.
+    """
+    query = parse_qs(urlsplit(path).query)
+    scale = _number(query, "scale", float, MIN_SCALE, 1.0)
+    fps = _number(query, "fps", float, 0, MAX_FPS)
+    quality = _number(query, "quality", int, 1, 100)
+    overlay = _number(query, "overlay", int, 0, 1)
+    return StreamVariant(
+        None if scale is None else round(scale, 2),
+        0 if fps is None else round(fps, 1),
+        quality,
+        None if overlay is None else bool(overlay),
+    )
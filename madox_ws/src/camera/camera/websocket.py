@@ -0,0 +1,216 @@
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+URL_PATH_WS = "/camera.ws"
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# Frames sent and not yet acknowledged by the browser
+MAX_UNACKED = 2
+# How long the sender waits for an acknowledgement before sending anyway,
+# so a client that never acks still gets a frame now and then
+ACK_TIMEOUT_IN_SEC = 1.0
+MAX_MESSAGE_BYTES = 4096
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Prefix of every video message, big endian so DataView reads it directly:
+# frame sequence number (u64) and capture time in seconds since the epoch
+# (f64), followed by the JPEG bytes. The browser acknowledges a frame by
+# sending its sequence number back as a text message.
+FRAME_HEADER = struct.Struct("!Qd")
+
+
+class WebSocketError(ValueError):
+    pass
+
+
+def accept_key(key):
+    digest = hashlib.sha1((key + WS_GUID).encode("latin-1")).digest()
+    return base64.b64encode(digest).decode("latin-1")
+
+
+def handshake(headers):
+    """Response to an upgrade request, headers are lowercased.
+
+    Raises WebSocketError when the request is not a WebSocket handshake.
+    """
+    if "websocket" not in headers.get("upgrade", "").lower():
+        raise WebSocketError("not a websocket upgrade")
+    key = headers.get("sec-websocket-key")
+    if not key:
+        raise WebSocketError("missing Sec-WebSocket-Key")
+    # The status line must be HTTP/1.1 whatever the server speaks otherwise
+    return (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "Sec-WebSocket-Accept: {}\r\n\r\n".format(accept_key(key))
+    ).encode("latin-1")
+
+
+def frame_head(opcode, length):
+    # Server to client frames are never masked nor fragmented
+    if length < 126:
+        return struct.pack("!BB", 0x80 | opcode, length)
+    if length < 1 << 16:
+        return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+
+def video_head(encoded):
+    # Everything in front of the JPEG bytes of a video message, the bytes
+    # themselves are sent as they are in the EncodedFrame
+    header = FRAME_HEADER.pack(encoded.seq, encoded.timestamp)
+    return frame_head(OP_BINARY, len(header) + encoded.nbytes) + header
+
+
+def control_frame(opcode, payload=b""):
+    return frame_head(opcode, len(payload)) + payload
+
+
+class MessageReader(object):
+    """Parses the masked frames sent by the browser.
+
+    feed() takes whatever was received and returns the complete
+    (opcode, payload) messages. Client messages are small, anything larger
+    than MAX_MESSAGE_BYTES or fragmented is refused.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        messages = []
+        while True:
+            message = self._next()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def _next(self):
+        buf = self._buffer
+        if len(buf) < 2:
+            return None
+        fin, opcode = buf[0] & 0x80, buf[0] & 0x0F
+        masked, length = buf[1] & 0x80, buf[1] & 0x7F
+        if not fin:
+            raise WebSocketError("fragmented messages are not supported")
+        if not masked:
+            raise WebSocketError("client frames must be masked")
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            (length,) = struct.unpack_from("!H", buf, 2)
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            (length,) = struct.unpack_from("!Q", buf, 2)
+            pos = 10
+        if length > MAX_MESSAGE_BYTES:
+            raise WebSocketError("message too large")
+        if len(buf) < pos + 4 + length:
+            return None
+        mask = buf[pos : pos + 4]
+        payload = bytes(
+            b ^ mask[i % 4] for i, b in enumerate(buf[pos + 4 : pos + 4 + length])
+        )
+        del buf[: pos + 4 + length]
+        return opcode, payload
+
+
+def parse_ack(payload):
+    try:
+        return int(payload.decode("ascii").strip())
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+class AckWindow(object):
+    """Frames in flight on one WebSocket.
+
+    The sender asks can_send() before every frame and the reader calls
+    ack() with each acknowledgement. An ack also covers every frame sent
+    before it, so a lost message does not stall the stream.
+    """
+
+    def __init__(self, size=MAX_UNACKED):
+        self.size = size
+        self._pending = []
+        self.last_ack = 0
+
+    def can_send(self):
+        return len(self._pending) < self.size
+
+    def sent(self, seq):
+        self._pending.append(seq)
+
+    def ack(self, seq):
+        self.last_ack = max(self.last_ack, seq)
+        self._pending = [s for s in self._pending if s > seq]
+
+    def expire(self):
+        # Called when no ack came in time: forget the oldest frame in flight
+        if self._pending:
+            self._pending.pop(0)
+
+
+class AckReader(threading.Thread):
+    """Reads the browser's messages for the threaded server.
+
+    recv is the socket's recv, the buffered rfile does not survive the
+    socket timeouts of stream connections. Acks go to the AckWindow and
+    wake the sender waiting on cond, pings are answered with send(), which
+    must serialise writes with the sender.
+    closed is set when the browser closes or the connection fails.
+    """
+
+    def __init__(self, recv, send, window, cond):
+        super().__init__(name="websocket-acks", daemon=True)
+        self.recv = recv
+        self.send = send
+        self.window = window
+        self.cond = cond
+        self.closed = False
+
+    def run(self):
+        parser = MessageReader()
+        try:
+            while not self.closed:
+                try:
+                    data = self.recv(MAX_MESSAGE_BYTES)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                for opcode, payload in parser.feed(data):
+                    if not self.handle(opcode, payload):
+                        return
+        except (OSError, WebSocketError):
+            pass
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+
+    def handle(self, opcode, payload):
+        if opcode == OP_CLOSE:
+            self.send(control_frame(OP_CLOSE))
+            return False
+        if opcode == OP_PING:
+            self.send(control_frame(OP_PONG, payload))
+        elif opcode in (OP_TEXT, OP_BINARY):
+            seq = parse_ack(payload)
+            if seq is not None:
+                with self.cond:
+                    self.window.ack(seq)
+                    self.cond.notify_all()
+        return True
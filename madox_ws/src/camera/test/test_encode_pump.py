@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from camera.camera import Frame
+from camera.encoder import PLAIN_MODE, EncodeCache, EncodePump
+from camera.quality import quality_tiers
+from camera.stream_session import StreamSession, default_key
+
+TIERS = quality_tiers(40, 90, 10)
+
+
+class OneFrameCamera(object):
+    # Hands out a single frame, then reports the camera closed
+    def __init__(self, frame):
+        self.frame = frame
+
+    def is_opened(self):
+        return self.frame is not None
+
+    def wait_frame(self, seq, timeout):
+        frame, self.frame = self.frame, None
+        return frame
+
+
+def counting_cache():
+    renders = []
+
+    def render(image, key):
+        renders.append(key)
+        return image
+
+    return EncodeCache(render), renders
+
+
+def test_pilot_and_pump_share_one_encode():
+    encoder, renders = counting_cache()
+    frame = Frame(1, time.time(), np.zeros((48, 64, 3), np.uint8))
+    session = StreamSession(("127.0.0.1", 0), TIERS)
+    try:
+        pilot = encoder.get(session.key(0), frame)
+    finally:
+        session.close()
+    sunk = []
+    pump = EncodePump(OneFrameCamera(frame), encoder, lambda: default_key(0, TIERS))
+    pump.add_sink(sunk.append)
+    pump.run()
+    assert sunk == [pilot]
+    assert len(renders) == 1
+
+
+def test_pump_encodes_without_clients():
+    encoder, renders = counting_cache()
+    frame = Frame(1, time.time(), np.zeros((48, 64, 3), np.uint8))
+    sunk = []
+    key = default_key(PLAIN_MODE, TIERS)
+    pump = EncodePump(OneFrameCamera(frame), encoder, lambda: key)
+    pump.add_sink(sunk.append)
+    pump.run()
+    assert [encoded.key for encoded in sunk] == [key]
+    assert renders == [key]
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from camera.encoder import EncodedFrame, StreamKey
+from camera.playback import PlaybackCursor, PlaybackError, parse_playback_query
+from camera.recorder import INDEX_SUFFIX, SEGMENT_SUFFIX, SegmentRecorder
+
+KEY = StreamKey(0, 80, 1.0)
+START = 1000.0
+# Exact in binary: 8 frames per one second segment
+PERIOD = 0.125
+
+
+def jpeg(seq):
+    return b"\xff\xd8" + seq.to_bytes(4, "little") * 100 + b"\xff\xd9"
+
+
+@pytest.fixture
+def session(tmp_path):
+    # Three segments of 8 frames: seq 1-8, 9-16 and 17-24
+    recorder = SegmentRecorder(str(tmp_path), segment_seconds=1.0, queue_size=25)
+    recorder.session = "session"
+    recorder.start()
+    for seq in range(1, 25):
+        recorder.push(EncodedFrame(seq, START + seq * PERIOD, KEY, jpeg(seq)))
+    recorder.stop()
+    return recorder.session_dir
+
+
+def segment(session_dir, n, suffix=SEGMENT_SUFFIX):
+    return os.path.join(session_dir, "{:06d}{}".format(n, suffix))
+
+
+def play(cursor):
+    seqs = []
+    try:
+        while True:
+            frame = cursor.next()
+            if frame is None:
+                return seqs
+            _, timestamp, data = frame
+            seqs.append(round((timestamp - START) / PERIOD))
+            assert bytes(data) == jpeg(seqs[-1])
+            del data
+    finally:
+        cursor.close()
+
+
+def test_plays_every_segment(session):
+    assert play(PlaybackCursor(session)) == list(range(1, 25))
+
+
+def test_seeks_into_a_later_segment(session):
+    # t is counted from the first frame, seq 1
+    assert play(PlaybackCursor(session, t=1.5)) == list(range(13, 25))
+
+
+def test_seek_past_the_end_plays_nothing(session):
+    assert play(PlaybackCursor(session, t=60.0)) == []
+
+
+def test_fast_playback_skips_frames(session):
+    # 4x at 8 fps sends one frame in four of an 8 fps recording
+    assert play(PlaybackCursor(session, speed=4.0, max_fps=8.0)) == list(
+        range(1, 25, 4)
+    )
+
+
+def test_skips_a_segment_deleted_while_playing(session):
+    cursor = PlaybackCursor(session)
+    seqs = []
+    for _ in range(8):
+        _, timestamp, data = cursor.next()
+        del data
+        seqs.append(round((timestamp - START) / PERIOD))
+    # The quota removes the middle segment while the first one plays
+    os.remove(segment(session, 2))
+    os.remove(segment(session, 2, INDEX_SUFFIX))
+    assert seqs + play(cursor) == list(range(1, 9)) + list(range(17, 25))
+
+
+def test_skips_a_listed_segment_that_cannot_be_loaded(session):
+    # Half deleted by the quota: listed by its data file, index gone
+    os.remove(segment(session, 1, INDEX_SUFFIX))
+    assert play(PlaybackCursor(session)) == list(range(9, 25))
+
+
+def test_parse_playback_query(session):
+    directory = os.path.dirname(session)
+    assert parse_playback_query("/playback.mjpg?t=2&speed=4", directory) == (
+        directory + "/session",
+        2.0,
+        4.0,
+    )
+    with pytest.raises(PlaybackError):
+        parse_playback_query("/playback.mjpg?session=other", directory)
+    with pytest.raises(PlaybackError):
+        parse_playback_query("/playback.mjpg?speed=0", directory)
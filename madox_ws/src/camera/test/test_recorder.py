@@ -0,0 +1,140 @@
+import errno
+import os
+import time
+
+import camera.recorder
+from camera.encoder import EncodedFrame, StreamKey
+from camera.recorder import (
+    INDEX_RECORD,
+    INDEX_SUFFIX,
+    SegmentReader,
+    SegmentRecorder,
+    list_segments,
+    list_sessions,
+)
+
+KEY = StreamKey(0, 80, 1.0)
+START = 1000.0
+# Exact in binary, so a segment holds a known number of frames
+PERIOD = 0.125
+
+
+def jpeg(seq):
+    return b"\xff\xd8" + seq.to_bytes(4, "little") * 250 + b"\xff\xd9"
+
+
+def record(directory, count, session=None, **kwargs):
+    recorder = SegmentRecorder(str(directory), queue_size=count + 1, **kwargs)
+    if session is not None:
+        recorder.session = session
+    recorder.start()
+    for seq in range(1, count + 1):
+        recorder.push(EncodedFrame(seq, START + seq * PERIOD, KEY, jpeg(seq)))
+    recorder.stop()
+    return recorder
+
+
+def test_index_round_trip(tmp_path):
+    recorder = record(tmp_path, 5)
+    (segment,) = list_segments(recorder.session_dir)
+    with open(segment[: -len(".mjpg")] + INDEX_SUFFIX, "rb") as f:
+        index = f.read()
+    assert len(index) == 5 * INDEX_RECORD.size
+    with open(segment, "rb") as f:
+        data = f.read()
+    for i, (offset, size, timestamp, seq) in enumerate(INDEX_RECORD.iter_unpack(index)):
+        assert seq == i + 1
+        assert timestamp == START + seq * PERIOD
+        assert data[offset : offset + size] == jpeg(seq)
+    reader = SegmentReader(segment)
+    try:
+        assert len(reader) == 5
+        assert reader.find(START + 3 * PERIOD) == 2
+        timestamp, seq, frame = reader.frame(2)
+        assert (timestamp, seq, bytes(frame)) == (START + 3 * PERIOD, 3, jpeg(3))
+        del frame
+    finally:
+        reader.close()
+
+
+def test_segments_rotate(tmp_path):
+    recorder = record(tmp_path, 24, segment_seconds=1.0)
+    segments = list_segments(recorder.session_dir)
+    assert [os.path.basename(path) for path in segments] == [
+        "000001.mjpg",
+        "000002.mjpg",
+        "000003.mjpg",
+    ]
+    seqs = []
+    for path in segments:
+        reader = SegmentReader(path)
+        try:
+            assert len(reader) == 8
+            seqs.extend(entry[3] for entry in reader.records)
+        finally:
+            reader.close()
+    assert seqs == list(range(1, 25))
+
+
+def test_quota_keeps_newest_segments(tmp_path):
+    segment_bytes = record(tmp_path / "full", 24, segment_seconds=1.0)._total // 3
+    recorder = record(
+        tmp_path / "kept", 24, segment_seconds=1.0, quota_bytes=2 * segment_bytes
+    )
+    assert [os.path.basename(path) for path in list_segments(recorder.session_dir)] == [
+        "000002.mjpg",
+        "000003.mjpg",
+    ]
+    assert recorder._total == 2 * segment_bytes
+
+
+def test_quota_covers_earlier_sessions(tmp_path):
+    first = record(tmp_path, 24, segment_seconds=1.0, session="first")
+    segment_bytes = first._total // 3
+    second = record(
+        tmp_path,
+        8,
+        segment_seconds=1.0,
+        quota_bytes=3 * segment_bytes,
+        session="second",
+    )
+    assert list_sessions(str(tmp_path)) == ["first", "second"]
+    assert [os.path.basename(path) for path in list_segments(first.session_dir)] == [
+        "000002.mjpg",
+        "000003.mjpg",
+    ]
+    assert len(list_segments(second.session_dir)) == 1
+
+
+def test_write_error_starts_new_segment(tmp_path, monkeypatch):
+    monkeypatch.setattr(camera.recorder, "RETRY_IN_SEC", 0.0)
+    recorder = SegmentRecorder(str(tmp_path), segment_seconds=1.0, queue_size=25)
+    open_segment = recorder._open_segment
+
+    def full_disk(data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def open_full_first(timestamp):
+        open_segment(timestamp)
+        if recorder._segment == 1:
+            recorder._data.write = full_disk
+
+    recorder._open_segment = open_full_first
+    recorder.start()
+    for seq in range(1, 9):
+        recorder.push(EncodedFrame(seq, START + seq * PERIOD, KEY, jpeg(seq)))
+    deadline = time.monotonic() + 5.0
+    while recorder.dropped < 8 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert recorder.is_alive()
+    for seq in range(9, 25):
+        recorder.push(EncodedFrame(seq, START + seq * PERIOD, KEY, jpeg(seq)))
+    recorder.stop()
+    segments = list_segments(recorder.session_dir)
+    assert len(segments) >= 2
+    reader = SegmentReader(segments[-1])
+    try:
+        assert reader.records[-1][3] == 24
+    finally:
+        reader.close()
+    assert recorder.dropped == 8